@@ -0,0 +1,68 @@
+"""Compare durations_from_rows with and without numpy on rows like the
+ones given by the leaders query.
+
+Run from the repository root:
+
+    python benchmarks/durations.py [rows]
+"""
+import os
+import sys
+import time
+import random
+import timeit
+import uuid
+
+sys.path.append(os.getcwd())
+from rana.blueprints.durations import (
+    _durations_from_rows_np,
+    _durations_from_rows_py,
+)
+
+USERS = 100
+
+
+def make_rows(count: int) -> list:
+    """Make window query rows for a week of heartbeats, ordered by
+    user and time."""
+    rows = []
+    per_user = count // USERS
+    now = time.time()
+
+    for _ in range(USERS):
+        user_id = uuid.uuid4()
+        hb_time = now - 7 * 86400
+        project = 1
+
+        for _ in range(per_user):
+            # people mostly stick to one project, with the occasional
+            # switch or break
+            if random.random() < 0.02:
+                project = random.choice([1, 2, 3, None])
+
+            gap = 900 if random.random() < 0.05 else random.uniform(1, 120)
+            next_time = hb_time + gap
+
+            rows.append(
+                (user_id, random.choice([1, 2, None]), project, hb_time, next_time)
+            )
+            hb_time = next_time
+
+    return rows
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rows = make_rows(count)
+
+    assert _durations_from_rows_np(rows, True) == _durations_from_rows_py(rows, True)
+
+    for name, func in (
+        ("loop", _durations_from_rows_py),
+        ("numpy", _durations_from_rows_np),
+    ):
+        elapsed = min(timeit.repeat(lambda: func(rows, True), number=1, repeat=3))
+        print(f"{name:>6}: {elapsed:.3f}s for {len(rows)} rows")
+
+
+if __name__ == "__main__":
+    main()
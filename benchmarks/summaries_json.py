@@ -0,0 +1,90 @@
+"""Compare encoding a summaries response with quart's encoder and with
+rana.utils.json_dumps (orjson, when it's installed).
+
+Run from the repository root:
+
+    python benchmarks/summaries_json.py [days]
+"""
+import os
+import sys
+import json
+import random
+import timeit
+import datetime
+
+import pytz
+
+sys.path.append(os.getcwd())
+from rana.blueprints.summaries import _summary_for_day
+from rana.utils import json_dumps, orjson
+from quart.json import JSONEncoder as QuartJSONEncoder
+
+PROJECTS = [f"project-{idx}" for idx in range(20)]
+LANGUAGES = ["Python", "Rust", "Markdown", "YAML", None]
+BRANCHES = ["master", "dev", None]
+
+
+def make_summaries(days: int) -> dict:
+    """Make the summaries of the given amount of busy days."""
+    tz = pytz.timezone("America/Sao_Paulo")
+    start = datetime.date(2019, 1, 1)
+    summaries = []
+
+    for idx in range(days):
+        rollups = [
+            {
+                "project": random.choice(PROJECTS),
+                "language": random.choice(LANGUAGES),
+                "branch": random.choice(BRANCHES),
+                "total_seconds": random.uniform(60, 3600),
+            }
+            for _ in range(30)
+        ]
+
+        date = start + datetime.timedelta(days=idx)
+        summaries.append(_summary_for_day(date, tz, rollups))
+
+    return {"data": summaries, "start": start, "end": date}
+
+
+def _isoformat(summaries: dict) -> dict:
+    # what the summaries code did before the encoder knew about dates
+    return {
+        "data": [
+            {
+                **summary,
+                "range": {
+                    **summary["range"],
+                    "start": summary["range"]["start"].isoformat(),
+                    "end": summary["range"]["end"].isoformat(),
+                },
+            }
+            for summary in summaries["data"]
+        ],
+        "start": summaries["start"].isoformat(),
+        "end": summaries["end"].isoformat(),
+    }
+
+
+def quart_dumps(data) -> bytes:
+    """Encode like quart's jsonify does by default."""
+    return json.dumps(
+        _isoformat(data), cls=QuartJSONEncoder, sort_keys=True, separators=(",", ":")
+    ).encode()
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 365
+    summaries = make_summaries(days)
+
+    assert json.loads(json_dumps(summaries)) == json.loads(quart_dumps(summaries))
+    print(f"json_dumps uses {'orjson' if orjson is not None else 'the stdlib'}")
+
+    for name, func in (("quart", quart_dumps), ("rana", json_dumps)):
+        elapsed = min(timeit.repeat(lambda: func(summaries), number=10, repeat=3)) / 10
+        size = len(func(summaries))
+        print(f"{name:>6}: {elapsed * 1000:.2f}ms for {days} days ({size} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare the per-heartbeat cost of validating heartbeats with
+cerberus and with the compiled validator.
+
+Run from the repository root:
+
+    python benchmarks/validation.py
+"""
+import os
+import sys
+import time
+import random
+import timeit
+
+sys.path.append(os.getcwd())
+from rana.models import (
+    HEARTBEAT_MODEL,
+    HEARTBEATS_BULK_IN,
+    compiled_schema,
+    _cerberus_validate,
+)
+
+BULK_SIZE = 500
+
+
+def make_heartbeat() -> dict:
+    return {
+        "entity": f"/home/uwu/src/{random.randint(0, 100)}.py",
+        "type": "file",
+        "category": "coding",
+        "time": str(time.time() + random.random()),
+        "project": "rana",
+        "branch": "master",
+        "language": "Python",
+        "lines": str(random.randint(0, 1000)),
+        "lineno": random.randint(0, 1000),
+        "cursorpos": random.randint(0, 1000),
+        "is_write": random.random() < 0.5,
+        "user_agent": "wakatime/13.0.0",
+    }
+
+
+def bench(name: str, func, count: int, runs: int = 5):
+    best = min(timeit.repeat(func, number=1, repeat=runs))
+    print(f"{name:>30}: {best / count * 1_000_000:8.2f} us/heartbeat")
+
+
+def main():
+    heartbeat = make_heartbeat()
+    bulk = {"hbs": [make_heartbeat() for _ in range(BULK_SIZE)]}
+
+    compiled_single = compiled_schema(HEARTBEAT_MODEL)
+    compiled_bulk = compiled_schema(HEARTBEATS_BULK_IN)
+
+    print(f"single heartbeat (x1000), bulk of {BULK_SIZE} heartbeats")
+
+    bench(
+        "cerberus single",
+        lambda: [_cerberus_validate(heartbeat, HEARTBEAT_MODEL) for _ in range(1000)],
+        1000,
+    )
+    bench(
+        "compiled single",
+        lambda: [compiled_single.validate(heartbeat) for _ in range(1000)],
+        1000,
+    )
+    bench(
+        "cerberus bulk",
+        lambda: _cerberus_validate(bulk, HEARTBEATS_BULK_IN),
+        BULK_SIZE,
+    )
+    bench("compiled bulk", lambda: compiled_bulk.validate(bulk), BULK_SIZE)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,131 @@
 import binascii
 import asyncio
 import base64
+import time
 import uuid
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional
 
 import bcrypt
 from quart import request, current_app as app
 
-from rana.errors import Unauthorized
+from rana.errors import Unauthorized, ServiceUnavailable
+
+log = logging.getLogger(__name__)
+
+
+def _timed(func, *args):
+    """Run a function, returning the monotonic time it started at, the
+    time it took, and its result. Runs inside the executor."""
+    start = time.monotonic()
+    result = func(*args)
+    return start, time.monotonic() - start, result
+
+
+class PasswordPool:
+    """Dedicated executor for bcrypt hashing and checking.
+
+    Password work never runs on the loop's default executor, so bursts
+    of logins and signups can't starve anything else that uses it. When
+    more than max_waiting jobs are queued behind the workers, new jobs
+    fail right away with ServiceUnavailable.
+    """
+
+    def __init__(self, workers: int = 2, max_waiting: int = 16, processes=False):
+        self.workers = workers
+        self.max_waiting = max_waiting
+
+        executor_cls = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.executor: Executor = executor_cls(max_workers=workers)
+
+        # jobs submitted and not finished yet
+        self.pending = 0
+
+        # counters
+        self.jobs = 0
+        self.rejected = 0
+        self.total_wait_time = 0.0
+        self.total_hash_time = 0.0
+
+    @classmethod
+    def from_config(cls, cfg) -> "PasswordPool":
+        return cls(
+            workers=cfg.getint("rana", "password_workers", fallback=2),
+            max_waiting=cfg.getint("rana", "password_max_waiting", fallback=16),
+            processes=cfg.getboolean("rana", "password_processes", fallback=False),
+        )
+
+    async def run(self, func, *args, loop=None):
+        """Run func(*args) on the pool."""
+        loop = loop or asyncio.get_event_loop()
+
+        if self.pending >= self.workers + self.max_waiting:
+            self.rejected += 1
+            raise ServiceUnavailable("too many password operations, try again")
+
+        self.pending += 1
+        submitted_at = time.monotonic()
+
+        try:
+            started_at, hash_time, result = await loop.run_in_executor(
+                self.executor, _timed, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+        self.jobs += 1
+        self.total_wait_time += started_at - submitted_at
+        self.total_hash_time += hash_time
+
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+_password_pool: Optional[PasswordPool] = None
+
+
+def setup_password_pool(cfg) -> PasswordPool:
+    """Create the password pool according to the given config."""
+    global _password_pool
+
+    if _password_pool is not None:
+        _password_pool.close()
+
+    _password_pool = PasswordPool.from_config(cfg)
+    return _password_pool
+
+
+def password_pool() -> PasswordPool:
+    """Return the password pool, creating one with the default
+    settings if none was set up."""
+    global _password_pool
+
+    if _password_pool is None:
+        _password_pool = PasswordPool()
+
+    return _password_pool
 
 
 async def hash_password(password: str, *, loop=None) -> str:
     """Generate a hash for any given password"""
-    loop = loop or asyncio.get_event_loop()
-
     password_bytes = bytes(password, "utf-8")
-    hashed = loop.run_in_executor(
-        None, bcrypt.hashpw, password_bytes, bcrypt.gensalt(14)
+    hashed = await password_pool().run(
+        bcrypt.hashpw, password_bytes, bcrypt.gensalt(14), loop=loop
     )
 
-    return (await hashed).decode("utf-8")
+    return hashed.decode("utf-8")
 
 
 async def check_password(pwd_hash_s: str, password_s: str, *, loop=None):
     """Check if any given two passwords match. Raises Unauthroized on
     invalid password."""
-    loop = loop or asyncio.get_event_loop()
     pwd_hash = pwd_hash_s.encode()
     password = password_s.encode()
 
-    valid = await loop.run_in_executor(None, bcrypt.checkpw, pwd_hash, password)
+    valid = await password_pool().run(bcrypt.checkpw, pwd_hash, password, loop=loop)
 
     if not valid:
         raise Unauthorized("invalid password")
@@ -48,17 +145,12 @@ async def token_check():
     except (binascii.Error, ValueError) as err:
         raise Unauthorized(f"Invalid API key provided: {err!r}")
 
-    user_row = await app.db.fetchrow(
-        """
-    select user_id from api_keys where key = $1
-    """,
-        api_key,
-    )
+    user_id = await app.db.fetch_api_key_user(api_key)
 
-    if not user_row:
+    if user_id is None:
         raise Unauthorized("Invalid API key")
 
-    return user_row[0]
+    return user_id
 
 
 async def login(username: str, password: str) -> uuid.UUID:
@@ -5,5 +5,15 @@ from .index import bp as index
 from .durations import bp as durations
 from .summaries import bp as summaries
 from .leaders import bp as leaders
+from .metrics import bp as metrics
 
-__all__ = ["heartbeats", "users", "auth", "index", "durations", "summaries", "leaders"]
+__all__ = [
+    "heartbeats",
+    "users",
+    "auth",
+    "index",
+    "durations",
+    "summaries",
+    "leaders",
+    "metrics",
+]
@@ -164,12 +164,7 @@ async def dashboard_handler():
     if not key:
         return redirect("/login")
 
-    user_id = await app.db.fetchval(
-        """
-    select user_id from api_keys where key = $1
-    """,
-        str(key),
-    )
+    user_id = await app.db.fetch_api_key_user(str(key))
 
     if user_id is None:
         return redirect("/login")
@@ -187,13 +182,7 @@ async def revoke_api_key():
 
     new_api_key = uuid.uuid4()
 
-    await app.db.execute(
-        """
-    update api_keys set key = $2 where key = $1
-    """,
-        str(old_api_key),
-        str(new_api_key),
-    )
+    await app.db.revoke_api_key(str(old_api_key), str(new_api_key))
 
     session["api_key"] = new_api_key
     return redirect("/dashboard")
@@ -4,15 +4,22 @@
 import uuid
 import logging
 import datetime
-from typing import List, Dict, Any, Tuple
+from operator import itemgetter
+from typing import List, Dict, Any, Tuple, Optional
 
-import pytz
 from quart import Blueprint, request, jsonify, current_app as app
 
 from rana.auth import token_check
 from rana.utils import jsonify
 from rana.models import validate, DURATIONS_IN
 from rana.database import timestamp_
+from rana.context import user_context
+from rana.timezones import get_timezone, timezone_table
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 log = logging.getLogger(__name__)
 bp = Blueprint("durations", __name__)
@@ -26,8 +33,7 @@ def _isofy(posix_tstamp: int) -> str:
 def posix_dt_user(posix_tstamp: float, user_tz) -> datetime.datetime:
     """From a posix timestamp (without timezone), convert it to a
     datetime object that is in view with the given user_tz."""
-    dt = datetime.datetime.fromtimestamp(posix_tstamp)
-    return dt.astimezone(user_tz)
+    return timezone_table(user_tz).fromtimestamp(posix_tstamp)
 
 
 def convert_tz(dtime: datetime.datetime, old_tz: datetime.timezone, new_tz: str):
@@ -46,8 +52,7 @@ def convert_tz(dtime: datetime.datetime, old_tz: datetime.timezone, new_tz: str)
         tzinfo=old_tz,
     )
 
-    new_as_tz = pytz.timezone(new_tz)
-    return aware_dtime.astimezone(new_as_tz)
+    return aware_dtime.astimezone(get_timezone(new_tz))
 
 
 def _dur(row, do_user=False):
@@ -57,11 +62,19 @@ def _dur(row, do_user=False):
     if do_user:
         duration["user_id"] = row[0]
 
+    # rows from the durations table also carry a branch
+    if len(row) > 5:
+        duration["branch"] = row[5]
+
     return duration
 
 
-def durations_from_rows(rows, *, do_user=False) -> List[Dict[str, Any]]:
-    """Make a list of durations out of a list of heartbeats."""
+# heartbeats this many seconds apart (or more) are never part of the
+# same duration
+DURATION_GAP = 600
+
+
+def _durations_from_rows_py(rows, do_user: bool) -> List[Dict[str, Any]]:
     durations_lst: List[Dict[str, Any]] = []
 
     for row in rows:
@@ -76,7 +89,7 @@ def durations_from_rows(rows, *, do_user=False) -> List[Dict[str, Any]]:
             # - if the incoming row is at MOST 10 minutes separated
             #   from the latest duration
             is_same_project = row[2] == lat_duration["project"]
-            is_mergeable = (row[3] - lat_duration["end"]) < 600
+            is_mergeable = (row[3] - lat_duration["end"]) < DURATION_GAP
 
             if is_same_project and is_mergeable:
                 lat_duration["end"] = row[4]
@@ -88,66 +101,308 @@ def durations_from_rows(rows, *, do_user=False) -> List[Dict[str, Any]]:
     return durations_lst
 
 
-async def calc_durations(
-    user_id: uuid.UUID, spans: Tuple[int, int], *, more_raw=False
+def _durations_from_rows_np(rows, do_user: bool) -> List[Dict[str, Any]]:
+    if not rows:
+        return []
+
+    count = len(rows)
+    projects = numpy.array(list(map(itemgetter(2), rows)), dtype=object)
+    starts = numpy.fromiter(map(itemgetter(3), rows), numpy.float64, count)
+    ends = numpy.fromiter(map(itemgetter(4), rows), numpy.float64, count)
+
+    # the latest duration always ends where the previous row ends,
+    # so a row starts a new duration if it changes project or is too
+    # far from the previous row. "not <" keeps NaN behaving like the
+    # loop does.
+    breaks = numpy.empty(count, dtype=bool)
+    breaks[0] = True
+    breaks[1:] = (projects[1:] != projects[:-1]) | ~(
+        (starts[1:] - ends[:-1]) < DURATION_GAP
+    )
+
+    firsts = numpy.flatnonzero(breaks)
+    lasts = numpy.append(firsts[1:] - 1, count - 1)
+
+    durations_lst = []
+    for first, last in zip(firsts.tolist(), lasts.tolist()):
+        # values come from the rows themselves, not the arrays, so
+        # their types are the same as the ones from the loop.
+        duration = _dur(rows[first], do_user)
+        duration["end"] = rows[last][4]
+        durations_lst.append(duration)
+
+    return durations_lst
+
+
+def durations_from_rows(rows, *, do_user=False) -> List[Dict[str, Any]]:
+    """Make a list of durations out of a list of heartbeats.
+
+    Rows are (user_id, language, project, start, end), sorted by start.
+    Uses numpy when it is installed.
+    """
+    if numpy is None:
+        return _durations_from_rows_py(rows, do_user)
+
+    return _durations_from_rows_np(rows, do_user)
+
+
+# a heartbeat as seen by the durations table:
+# (time, project_id, language_id, branch_id)
+DurationHeartbeat = Tuple[float, Optional[int], Optional[int], Optional[int]]
+
+
+def _rows_from_heartbeats(user_id, heartbeats: List[DurationHeartbeat]) -> list:
+    """Make rows like the ones given by the durations window query out
+    of a list of heartbeats sorted by time."""
+    return [
+        (user_id, current[2], current[1], current[0], following[0], current[3])
+        for current, following in zip(heartbeats, heartbeats[1:])
+        if following[0] - current[0] < DURATION_GAP
+    ]
+
+
+async def _insert_durations(conn, user_id, durations_lst: List[Dict[str, Any]]):
+    if not durations_lst:
+        return
+
+    await conn.execute(
+        """
+    insert into durations (id, user_id, language_id, project_id,
+        started_at, ended_at, branch_id)
+    select d.id, $1, d.language_id, d.project_id, d.started_at, d.ended_at,
+           d.branch_id
+    from unnest($2::uuid[], $3::int[], $4::int[], $5::float8[], $6::float8[],
+                $7::int[])
+        as d(id, language_id, project_id, started_at, ended_at, branch_id)
+    """,
+        user_id,
+        [uuid.uuid4() for _ in durations_lst],
+        [dur["language"] for dur in durations_lst],
+        [dur["project"] for dur in durations_lst],
+        [dur["start"] for dur in durations_lst],
+        [dur["end"] for dur in durations_lst],
+        [dur["branch"] for dur in durations_lst],
+    )
+
+
+async def _append_durations(
+    conn, user_id, latest: Optional[DurationHeartbeat], heartbeats: list
+):
+    """Extend the user's durations with heartbeats that are all newer
+    than the user's latest heartbeat."""
+    last = await conn.fetchrow(
+        """
+    select id, user_id, language_id, project_id, started_at, ended_at, branch_id
+    from durations
+    where user_id = $1
+    order by ended_at desc
+    limit 1
+    """,
+        user_id,
+    )
+
+    rows = _rows_from_heartbeats(user_id, ([latest] if latest else []) + heartbeats)
+    if not rows:
+        return
+
+    # the latest duration goes in as the first row, so that new rows
+    # merge into it the same way they would on a full recalculation.
+    seed = [tuple(last[1:])] if last else []
+    durations_lst = durations_from_rows(seed + rows)
+
+    if last:
+        last_duration = durations_lst.pop(0)
+
+        if last_duration["end"] != last["ended_at"]:
+            await conn.execute(
+                """
+            update durations set ended_at = $2 where id = $1
+            """,
+                last["id"],
+                last_duration["end"],
+            )
+
+    await _insert_durations(conn, user_id, durations_lst)
+
+
+async def rebuild_durations(
+    conn, user_id, start: float, end: float
+) -> Tuple[float, float]:
+    """Recalculate the user's durations around the given span out of
+    their heartbeats.
+
+    The span is widened to cover every duration that could be affected
+    by heartbeats inside it, and returned. Must run inside a transaction.
+    """
+    # the heartbeats right outside of the span can pair up with the
+    # ones inside it
+    before, after = await conn.fetchrow(
+        """
+    select
+        (select max(time) from heartbeats
+         where user_id = $1 and is_write = true and time < $2),
+        (select min(time) from heartbeats
+         where user_id = $1 and is_write = true and time > $3)
+    """,
+        user_id,
+        start,
+        end,
+    )
+
+    start = start if before is None else before
+    end = end if after is None else after
+
+    # durations never overlap, so everything outside of these ends
+    # before the span starts or starts after it ends, and stays as is.
+    old_rows = await conn.fetch(
+        """
+    select id, started_at, ended_at
+    from durations
+    where user_id = $1 and ended_at >= $2 and started_at <= $3
+    """,
+        user_id,
+        start,
+        end,
+    )
+
+    start = min([start] + [row[1] for row in old_rows])
+    end = max([end] + [row[2] for row in old_rows])
+
+    heartbeats = await conn.fetch(
+        """
+    select distinct time, project_id, language_id, branch_id
+    from heartbeats
+    where user_id = $1 and is_write = true and time >= $2 and time <= $3
+    order by time
+    """,
+        user_id,
+        start,
+        end,
+    )
+
+    await conn.execute(
+        """
+    delete from durations where id = any($1::uuid[])
+    """,
+        [row[0] for row in old_rows],
+    )
+
+    rows = _rows_from_heartbeats(user_id, [tuple(row) for row in heartbeats])
+    await _insert_durations(conn, user_id, durations_from_rows(rows))
+
+    return start, end
+
+
+async def update_durations(
+    conn, user_id, heartbeats: List[DurationHeartbeat], heartbeat_ids: list
+) -> Optional[Tuple[float, float]]:
+    """Update the user's durations with the given new write heartbeats.
+
+    Must run in the same transaction that inserted the heartbeats,
+    given by heartbeat_ids. Returns the span where durations changed.
+    """
+    if not heartbeats:
+        return None
+
+    heartbeats = sorted(set(heartbeats), key=lambda heartbeat: heartbeat[0])
+
+    # a user's durations are updated by one transaction at a time
+    await conn.execute(
+        """
+    select pg_advisory_xact_lock(hashtext($1))
+    """,
+        str(user_id),
+    )
+
+    latest = await conn.fetchrow(
+        """
+    select time, project_id, language_id, branch_id
+    from heartbeats
+    where user_id = $1 and is_write = true and not (id = any($2::uuid[]))
+    order by time desc
+    limit 1
+    """,
+        user_id,
+        heartbeat_ids,
+    )
+
+    if latest is None or latest[0] <= heartbeats[0][0]:
+        await _append_durations(
+            conn, user_id, tuple(latest) if latest else None, heartbeats
+        )
+
+        # the latest duration might get extended up from the
+        # latest heartbeat
+        start = latest[0] if latest else heartbeats[0][0]
+        return start, heartbeats[-1][0]
+
+    # heartbeats from the past, like an offline backlog
+    return await rebuild_durations(conn, user_id, heartbeats[0][0], heartbeats[-1][0])
+
+
+async def fetch_duration_rows(
+    conn, user_id, spans: Tuple[float, float], **kwargs
 ) -> list:
-    """Iteraively calculate the durations of a given user based
-    on the heartbeats."""
+    """Fetch the durations of a given user, cut to the given span,
+    with interned string ids instead of strings.
+
+    Durations are sorted, never overlap, and have their start and end
+    as POSIX timestamps. conn can be a connection or the database, and
+    extra keyword arguments (like replica) go to its fetch_named.
+    """
     log.debug(
-        "calculating durations for uid %r, span0 %r, span1 %r",
+        "fetching durations for uid %r, span0 %r, span1 %r",
         user_id,
         spans[0],
         spans[1],
     )
 
-    # spans.0 and spans.1 are in utc, as posix timestamps.
-    # for all purposes, we want to convert from utc back to
-    # the user's local timestamp
-    rows = await app.db.fetch(
-        f"""
-    SELECT s.user_id, s.language, s.project, s.started_at, s.ended_at
-    FROM (
-        SELECT user_id, language, project, time AS started_at,
-               (LAG(time) OVER (ORDER BY time DESC)) AS ended_at
-        FROM heartbeats
-        WHERE user_id = $1 and time > $2 and time < $3 and is_write = true
-        GROUP BY user_id, language, project, time
-        ORDER BY started_at) AS s
-    WHERE s.ended_at - s.started_at < 600
-    """,
+    rows = await conn.fetch_named(
+        "durations_range",
         user_id,
         spans[0],
         spans[1],
+        **kwargs,
     )
 
-    durations_lst = durations_from_rows(rows)
-    user_tz = await app.db.fetch_user_tz(user_id)
+    return [_dur(row) for row in rows]
+
+
+async def fetch_durations(user_id: uuid.UUID, spans: Tuple[float, float]) -> list:
+    """Fetch the durations of a given user, cut to the given span."""
+    # heartbeats from the last few seconds can be missing here
+    durations_lst = await fetch_duration_rows(app.db, user_id, spans, replica=True)
+    await app.db.resolve_keys(durations_lst, "project", "language", "branch")
+    return durations_lst
+
+
+def convert_durations(durations_lst: list, tz_table) -> list:
+    """Convert durations given by fetch_durations to the API view,
+    on the timezone of the given table."""
 
     def _convert_duration(dur):
         # converting from UTC to user tz.
-        # pytz already assumes the timezone is UTC when the
-        # datetime object isn't timezone aware, which is good.
-        start = posix_dt_user(dur["start"], user_tz)
-        end = posix_dt_user(dur["end"], user_tz)
-
-        if more_raw:
-            return {
-                "project": dur["project"] or "Other",
-                "language": dur["language"] or "Other",
-                "start": start,
-                "end": end,
-            }
-
         return {
             "project": dur["project"] or "Other",
             "language": dur["language"] or "Other",
-            "start": start.isoformat(),
-            "end": end.isoformat(),
+            "start": tz_table.fromtimestamp(dur["start"]),
+            "end": tz_table.fromtimestamp(dur["end"]),
         }
 
     return list(map(_convert_duration, durations_lst))
 
 
+async def calc_durations(user_id: uuid.UUID, spans: Tuple[float, float]) -> list:
+    """Fetch the durations of a given user, cut to the given span,
+    on the user's timezone."""
+    # spans.0 and spans.1 are in utc, as posix timestamps.
+    # for all purposes, we want to convert from utc back to
+    # the user's local timestamp
+    durations_lst = await fetch_durations(user_id, spans)
+    tz_table = (await user_context(user_id)).tz_table
+    return convert_durations(durations_lst, tz_table)
+
+
 async def durations(user_id: uuid.UUID, args: dict):
     """Calculate user's durations for a given day (in args.date).
 
@@ -158,7 +413,7 @@ async def durations(user_id: uuid.UUID, args: dict):
     # make our calc_durations query.
     spans = args["date"].spans_as_dt
 
-    user_tz = await app.db.fetch_user_tz(user_id)
+    user_tz = (await user_context(user_id)).tz
     start = convert_tz(spans[0], user_tz, "UTC")
     end = convert_tz(spans[1], user_tz, "UTC")
 
@@ -170,8 +425,8 @@ async def durations(user_id: uuid.UUID, args: dict):
         durations_lst,
         extra={
             "branches": ["master"],
-            "start": start.isoformat(),
-            "end": end.isoformat(),
+            "start": start,
+            "end": end,
         },
     )
 
@@ -1,14 +1,19 @@
 import uuid
 import pathlib
 import logging
-from typing import Optional
+from collections import defaultdict
+from typing import Optional, List, Dict
 
-from quart import Blueprint, request, jsonify as qjsonify, current_app as app
+from quart import Blueprint, request, current_app as app
 
 from rana.auth import token_check
 from rana.errors import BadRequest
-from rana.models import validate, HEARTBEAT_MODEL
-from rana.utils import jsonify as jsonify
+from rana.database import heartbeat_simple
+from rana.blueprints.durations import update_durations
+from rana.rollups import mark_stale
+from rana.leaderboards import mark_days_stale
+from rana.models import validate, HEARTBEAT_MODEL, HEARTBEATS_BULK_IN
+from rana.utils import jsonify, json_response
 
 log = logging.getLogger(__name__)
 bp = Blueprint("heartbeats", __name__)
@@ -27,107 +32,226 @@ async def fetch_machine(user_id, mach_name=None, *, app_=None) -> uuid.UUID:
         except KeyError:
             mach_name = "root"
 
-    mach_id = await app_.db.fetchval(
-        """
-    select id from machines where name = $1 and user_id = $2
-    """,
-        mach_name,
-        user_id,
-    )
-
+    key = (user_id, mach_name)
+    mach_id = app_.db.machines.get(key)
     if mach_id is not None:
         return mach_id
 
-    mach_id = uuid.uuid4()
-
-    await app_.db.execute(
+    # the no-op update makes returning give us the existing row's id
+    # when another request created the machine first.
+    mach_id = await app_.db.fetchval(
         """
     insert into machines (id, user_id, name)
     values ($1, $2, $3)
+    on conflict (user_id, name) do update set name = excluded.name
+    returning id
     """,
-        mach_id,
+        uuid.uuid4(),
         user_id,
         mach_name,
     )
 
+    app_.db.machines.set(key, mach_id)
     return mach_id
 
 
 EXTENSIONS = {".zig": "Zig"}
 
 
-async def process_hb(user_id, machine_id, heartbeat, *, app_=None):
-    """Add a heartbeat."""
+def _fill_language(heartbeat: dict):
+    """Guess the heartbeat's language out of its entity's file
+    extension, if the client didn't give one."""
+    if heartbeat.get("language") is not None:
+        return
+
+    entity_path = heartbeat["entity"]
+
+    if entity_path.lower().startswith("c:"):
+        path = pathlib.PureWindowsPath(entity_path)
+    else:
+        path = pathlib.PurePosixPath(entity_path)
+
+    heartbeat["language"] = EXTENSIONS.get(path.suffix)
+
+
+def _is_close(time_a: float, time_b: float) -> bool:
+    """Return if two heartbeat times are close enough for the
+    heartbeats to be considered the same."""
+    return abs(time_a - time_b) < 60
+
+
+async def process_many_hbs(
+    user_id, machine_id, heartbeats: List[dict], *, app_=None
+) -> List[dict]:
+    """Add a list of heartbeats.
+
+    Returns the simple view of each given heartbeat, in order. Heartbeats
+    that are close to an existing one (in the database or earlier in the
+    given list) are not inserted, and the existing heartbeat is returned
+    in their place.
+    """
     app_ = app_ or app
-    heartbeat_id = uuid.uuid4()
 
-    if heartbeat.get("language") is None:
-        entity_path = heartbeat["entity"]
+    if not heartbeats:
+        return []
 
-        if entity_path.lower().startswith("c:"):
-            path = pathlib.PureWindowsPath(entity_path)
-        else:
-            path = pathlib.PurePosixPath(entity_path)
+    for heartbeat in heartbeats:
+        _fill_language(heartbeat)
 
-        heartbeat["language"] = EXTENSIONS.get(path.suffix)
+    recent = app_.db.recent_heartbeats
 
-    existing_hb = await app_.db.fetchval(
-        """
-    select id from heartbeats
-    where entity = $1 and abs(($2 - time)::bigint) < 60
-    limit 1
-    """,
-        heartbeat["entity"],
-        heartbeat["time"],
+    # index in the given list -> simple view of the close heartbeat
+    # that already exists for it
+    existing: Dict[int, dict] = {}
+
+    for idx, heartbeat in enumerate(heartbeats):
+        latest = recent.get((user_id, heartbeat["entity"]))
+        if latest is not None and _is_close(latest["time"], heartbeat["time"]):
+            existing[idx] = latest
+
+    unknown = [idx for idx in range(len(heartbeats)) if idx not in existing]
+
+    string_ids = await app_.db.intern(
+        value
+        for heartbeat in heartbeats
+        for value in (
+            heartbeat["entity"],
+            heartbeat["type"],
+            heartbeat.get("category"),
+            heartbeat["project"],
+            heartbeat["branch"],
+            heartbeat["language"],
+        )
     )
 
-    if existing_hb:
-        existing = await app_.db.fetch_heartbeat_simple(existing_hb)
+    def _ids(key: str, hbs) -> list:
+        return [string_ids.get(hb.get(key)) for hb in hbs]
+
+    async with app_.db.transaction() as conn:
+        # a single lookup for the close heartbeats of the entire batch,
+        # done as a range scan on heartbeats_user_entity_time_idx.
+        existing_rows = await conn.fetch_named(
+            "heartbeats_dedup",
+            user_id,
+            unknown,
+            _ids("entity", [heartbeats[idx] for idx in unknown]),
+            [heartbeats[idx]["time"] for idx in unknown],
+        )
+
+        for row in existing_rows:
+            existing[row[0]] = heartbeat_simple(row[1:])
+
+        # index in the given list -> id of the heartbeat it resolves to
+        resolved: Dict[int, uuid.UUID] = {}
+        to_insert: Dict[str, List[dict]] = defaultdict(list)
+
+        for idx, heartbeat in enumerate(heartbeats):
+            if idx in existing:
+                log.debug(
+                    "found close heartbeat: %r %r",
+                    existing[idx]["time"],
+                    heartbeat["time"],
+                )
+                continue
+
+            # heartbeats of the same batch deduplicate against each other
+            # the same way they would if they were inserted one by one.
+            close = next(
+                (
+                    other
+                    for other in to_insert[heartbeat["entity"]]
+                    if _is_close(other["time"], heartbeat["time"])
+                ),
+                None,
+            )
+
+            if close is not None:
+                resolved[idx] = close["id"]
+                continue
+
+            # heartbeats coming from the ingest queue already have an id
+            heartbeat.setdefault("id", uuid.uuid4())
+            resolved[idx] = heartbeat["id"]
+            to_insert[heartbeat["entity"]].append(heartbeat)
+
+        new_hbs = [hb for hbs in to_insert.values() for hb in hbs]
         log.debug(
-            "found close heartbeat: %r %r dt=%r",
-            existing["time"],
-            heartbeat["time"],
-            existing["time"] - heartbeat["time"],
+            "add %d heartbeats (of %d): uid=%r", len(new_hbs), len(heartbeats), user_id
         )
-        return existing
-
-    log.debug(
-        "add heartbeat %r: uid=%r entity=%r lang=%r",
-        heartbeat_id.hex,
-        user_id.hex,
-        heartbeat["entity"],
-        heartbeat["language"],
-    )
 
-    await app_.db.execute(
-        """
-        insert into heartbeats (id, user_id, machine_id,
-            entity, type, category, time,
-            is_write, project, branch, language, lines, lineno, cursorpos)
-        values
-            ($1, $2, $3,
-             $4, $5, $6,
-             $7, $8, $9,
-             $10, $11, $12,
-             $13, $14)
-        """,
-        heartbeat_id,
-        user_id,
-        machine_id,
-        heartbeat["entity"],
-        heartbeat["type"],
-        heartbeat["category"],
-        heartbeat["time"],
-        heartbeat["is_write"],
-        heartbeat["project"],
-        heartbeat["branch"],
-        heartbeat["language"],
-        heartbeat["lines"],
-        heartbeat["lineno"],
-        heartbeat["cursorpos"],
+        inserted_rows = await conn.fetch_named(
+            "heartbeats_insert",
+            user_id,
+            machine_id,
+            [hb["id"] for hb in new_hbs],
+            _ids("entity", new_hbs),
+            _ids("type", new_hbs),
+            _ids("category", new_hbs),
+            [hb["time"] for hb in new_hbs],
+            [hb["is_write"] for hb in new_hbs],
+            _ids("project", new_hbs),
+            _ids("branch", new_hbs),
+            _ids("language", new_hbs),
+            [hb["lines"] for hb in new_hbs],
+            [hb["lineno"] for hb in new_hbs],
+            [hb["cursorpos"] for hb in new_hbs],
+        )
+
+        changed = await update_durations(
+            conn,
+            user_id,
+            [
+                (
+                    hb["time"],
+                    string_ids.get(hb["project"]),
+                    string_ids.get(hb["language"]),
+                    string_ids.get(hb["branch"]),
+                )
+                for hb in new_hbs
+                if hb["is_write"]
+            ],
+            [hb["id"] for hb in new_hbs],
+        )
+
+        if changed is not None:
+            await mark_stale(conn, user_id, *changed)
+            await mark_days_stale(conn, *changed)
+
+    await app_.db.resolve_keys(
+        [existing[row[0]] for row in existing_rows], "entity", "type", "project"
     )
 
-    return await app_.db.fetch_heartbeat_simple(heartbeat_id)
+    # the strings are known already, no need to go through resolve
+    strings = {string_id: value for value, string_id in string_ids.items()}
+    inserted = {}
+
+    for row in inserted_rows:
+        heartbeat = heartbeat_simple(row)
+        for key in ("entity", "type", "project"):
+            heartbeat[key] = strings.get(heartbeat[key])
+
+        inserted[row[0]] = heartbeat
+
+    for heartbeat in inserted.values():
+        key = (user_id, heartbeat["entity"])
+        latest = recent.get(key)
+
+        if latest is None or latest["time"] <= heartbeat["time"]:
+            recent.set(key, heartbeat)
+
+    app_.metrics.heartbeats.inc(len(inserted), result="inserted")
+    app_.metrics.heartbeats.inc(len(heartbeats) - len(inserted), result="duplicate")
+
+    return [
+        existing[idx] if idx in existing else inserted[resolved[idx]]
+        for idx in range(len(heartbeats))
+    ]
+
+
+async def process_hb(user_id, machine_id, heartbeat, *, app_=None):
+    """Add a heartbeat."""
+    res = await process_many_hbs(user_id, machine_id, [heartbeat], app_=app_)
+    return res[0]
 
 
 @bp.route("/current/heartbeats", methods=["POST"])
@@ -137,6 +261,11 @@ async def post_heartbeat():
     j = validate(raw_json, HEARTBEAT_MODEL)
 
     machine_id = await fetch_machine(user_id)
+
+    if app.ingest is not None:
+        heartbeat = app.ingest.put_many(user_id, machine_id, [j])[0]
+        return jsonify(heartbeat), 202
+
     heartbeat = await process_hb(user_id, machine_id, j)
     return jsonify(heartbeat), 201
 
@@ -145,25 +274,19 @@ async def post_heartbeat():
 async def post_many_heartbeats():
     user_id = await token_check()
 
-    raw_json = await request.get_json()
+    # clients can gzip bulk payloads
+    raw_json = await app.compression.request_json()
     if not isinstance(raw_json, list):
         raise BadRequest("no heartbeat list provided")
 
-    j = validate(
-        {"hbs": raw_json},
-        {
-            "hbs": {
-                "type": "list",
-                "schema": {"type": "dict", "schema": HEARTBEAT_MODEL},
-            }
-        },
-    )["hbs"]
+    j = validate({"hbs": raw_json}, HEARTBEATS_BULK_IN)["hbs"]
 
     machine_id = await fetch_machine(user_id)
     log.debug("adding %d heartbeats", len(j))
 
-    res = []
-    for heartbeat in j:
-        res.append(await process_hb(user_id, machine_id, heartbeat))
+    if app.ingest is not None:
+        res = app.ingest.put_many(user_id, machine_id, j)
+        return json_response({"responses": res}), 202
 
-    return qjsonify({"responses": res}), 201
+    res = await process_many_hbs(user_id, machine_id, j)
+    return json_response({"responses": res}), 201
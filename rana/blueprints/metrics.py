@@ -0,0 +1,20 @@
+from quart import Blueprint, current_app as app
+
+from rana.errors import NotFound
+
+bp = Blueprint("metrics", __name__)
+
+
+@bp.route("/metrics")
+async def metrics_handler():
+    """Expose the app's metrics to Prometheus."""
+    # "metrics=" keeps them disabled too
+    enabled = app.cfg.get("rana", "metrics", fallback="")
+    if not enabled or not app.cfg.getboolean("rana", "metrics"):
+        raise NotFound("Metrics are disabled")
+
+    return (
+        app.metrics.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
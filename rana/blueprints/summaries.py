@@ -6,6 +6,7 @@ import datetime
 from collections import Counter
 from typing import List, Dict, Any
 
+import pytz
 from quart import Blueprint, request, jsonify, current_app as app
 
 from rana.auth import token_check
@@ -13,11 +14,16 @@ from rana.utils import jsonify
 from rana.models import validate, SUMMARIES_IN
 from rana.database import timestamp_
 from rana.errors import BadRequest
+from rana.context import user_context
 
-from rana.blueprints.durations import calc_durations, convert_tz
+from rana.rollups import day_spans, fetch_rollups
 
 bp = Blueprint("summaries", __name__)
 
+# summaries come from daily rollups, so long ranges are cheap
+MAX_SUMMARY_DAYS = 365
+
+
 # modification of https://stackoverflow.com/a/1060330
 def daterange(start_date, delta):
     """Yield dates, making a per-day iteration of the given start date until
@@ -50,67 +56,60 @@ def _do_summary_list(summary, sum_key: str, counter: Counter, total_seconds):
         )
 
 
-def _day_summary_projects(summary: Dict[str, Any], durations: List[Dict[str, Any]]):
+def _day_summary_projects(summary: Dict[str, Any], rollups: List[Dict[str, Any]]):
     projects_counter: Counter = Counter()
     langs_counter: Counter = Counter()
+    branches_counter: Counter = Counter()
     total_seconds = 0
 
-    for duration in durations:
-        duration_secs = (duration["end"] - duration["start"]).total_seconds()
+    for rollup in rollups:
+        seconds = rollup["total_seconds"]
 
-        projects_counter[duration["project"]] += duration_secs
-        langs_counter[duration["language"]] += duration_secs
-        total_seconds += duration_secs
+        projects_counter[rollup["project"] or "Other"] += seconds
+        langs_counter[rollup["language"] or "Other"] += seconds
+        branches_counter[rollup["branch"] or "Other"] += seconds
+        total_seconds += seconds
 
     summary["grand_total"] = {"total_seconds": total_seconds}
 
     # add projects list and languages list
     _do_summary_list(summary, "projects", projects_counter, total_seconds)
     _do_summary_list(summary, "languages", langs_counter, total_seconds)
+    _do_summary_list(summary, "branches", branches_counter, total_seconds)
 
 
-async def _summary_for_day(user_id, date: datetime.datetime) -> Dict[str, Any]:
-    """Generate a summary for the day.
-    Given date is assumed not-timezone-aware and on the user's
-    local timezone."""
+def _summary_for_day(date: datetime.date, tz, rollups) -> Dict[str, Any]:
+    """Generate a summary for the user's local day out of its rollups."""
     summary: Dict[str, Any] = {}
+    _day_summary_projects(summary, rollups)
 
-    user_tz = await app.db.fetch_user_tz(user_id)
-    date = convert_tz(date, user_tz, "UTC")
-
-    dur_start = date.timestamp()
-    day_delta = datetime.timedelta(hours=23, minutes=59, seconds=59)
-    dur_end = (date + day_delta).timestamp()
-
-    durations = await calc_durations(user_id, (dur_start, dur_end), more_raw=True)
-
-    _day_summary_projects(summary, durations)
-
+    start, end = day_spans(tz, date)
     summary["range"] = {
         "date": f"{date.year}-{date.month}-{date.day}",
-        "start": date.isoformat(),
-        "end": (date + day_delta).isoformat(),
+        "start": datetime.datetime.fromtimestamp(start, pytz.utc),
+        "end": datetime.datetime.fromtimestamp(end - 1, pytz.utc),
     }
 
     return summary
 
 
 async def make_summary(user_id: uuid.UUID, start_date, delta) -> List[Dict[str, Any]]:
-    """Make a summary for the given date and ending at the date + delta."""
-    data: List[Dict[str, Any]] = []
+    """Make a summary for the given date and ending at the date + delta.
 
-    for date in daterange(start_date, delta):
-        day_data = await _summary_for_day(user_id, date)
-        data.append(day_data)
+    Given dates are on the user's local timezone.
+    """
+    ctx = await user_context(user_id)
+    dates = [date.date() for date in daterange(start_date, delta)]
+    rollups = await fetch_rollups(app.db, user_id, ctx.tz, dates)
 
-    return data
+    return [_summary_for_day(date, ctx.tz, rollups.get(date, [])) for date in dates]
 
 
 @bp.route("/current/summaries")
 async def user_summary():
     """Generate a user summary given the start and end dates of the summary.
 
-    The max timedelta for a summary is 31 days.
+    The max timedelta for a summary is MAX_SUMMARY_DAYS days.
     """
     user_id = await token_check()
     args = validate(dict(request.args), SUMMARIES_IN)
@@ -120,11 +119,9 @@ async def user_summary():
         raise BadRequest("Invalid date range.")
 
     delta = end_date - start_date
-    if delta.days >= 32:
+    if delta.days >= MAX_SUMMARY_DAYS:
         raise BadRequest("Too many requested days.")
 
     data = await make_summary(user_id, start_date, delta)
 
-    return jsonify(
-        data, extra={"start": start_date.isoformat(), "end": end_date.isoformat()}
-    )
+    return jsonify(data, extra={"start": start_date, "end": end_date})
@@ -0,0 +1,139 @@
+import gzip
+import json
+import zlib
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from quart import request
+
+from rana.errors import BadRequest, PayloadTooLarge, UnsupportedMediaType
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# fast levels, as responses are compressed on every request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _gzip(data: bytes) -> bytes:
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def _brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def gunzip(data: bytes, max_size: int) -> bytes:
+    """Decompress gzipped data, refusing it once it goes past
+    max_size bytes."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    try:
+        res = decompressor.decompress(data, max_size + 1)
+    except zlib.error:
+        raise BadRequest("Invalid gzip body")
+
+    if len(res) > max_size or decompressor.unconsumed_tail:
+        raise PayloadTooLarge(f"Body is larger than {max_size} bytes")
+
+    if not decompressor.eof:
+        raise BadRequest("Truncated gzip body")
+
+    return res
+
+
+class Compression:
+    """Decompression of request bodies and compression of responses.
+
+    JSON responses of at least compress_min_size bytes are compressed
+    with the best encoding the client accepts. Bodies of at least
+    compress_offload_size bytes are (de)compressed on a thread, to keep
+    the event loop free.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.request_max_size = app.cfg.getint(
+            "rana", "request_max_size", fallback=8 * 1024 * 1024
+        )
+        self.min_size = app.cfg.getint("rana", "compress_min_size", fallback=1024)
+        self.offload_size = app.cfg.getint(
+            "rana", "compress_offload_size", fallback=65536
+        )
+
+        # most preferred first
+        self.encoders: Dict[str, Callable[[bytes], bytes]] = {}
+        if brotli is not None:
+            self.encoders["br"] = _brotli
+        self.encoders["gzip"] = _gzip
+
+    async def _run(self, func, data: bytes, *args) -> Any:
+        if len(data) < self.offload_size:
+            return func(data, *args)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, data, *args)
+
+    async def request_json(self) -> Any:
+        """Return the JSON body of the request, like request.get_json,
+        decompressing it first if it's gzipped."""
+        encoding = request.headers.get("Content-Encoding", "identity").lower()
+        if encoding == "identity":
+            return await request.get_json()
+
+        if encoding != "gzip":
+            raise UnsupportedMediaType(f"Unsupported content encoding {encoding!r}")
+
+        if not request.is_json:
+            return None
+
+        data = await request.get_data(raw=True)
+        body = await self._run(gunzip, data, self.request_max_size)
+
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise BadRequest("Invalid JSON body")
+
+    def _pick_encoding(self) -> Optional[str]:
+        accepted = request.accept_encodings
+
+        best, best_quality = None, 0.0
+        for encoding in self.encoders:
+            quality = accepted.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+
+        return best
+
+    async def compress_response(self, response):
+        """Compress the given response, if it's worth it and the client
+        accepts it."""
+        if (
+            response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers
+            or response.status_code < 200
+            or response.status_code == 204
+        ):
+            return response
+
+        body = await response.get_data(raw=True)
+        if len(body) < self.min_size:
+            return response
+
+        # caches must not give compressed bodies to everyone
+        response.headers.add("Vary", "Accept-Encoding")
+
+        encoding = self._pick_encoding()
+        if encoding is None:
+            return response
+
+        response.set_data(await self._run(self.encoders[encoding], body))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,50 @@
+import uuid
+from typing import Optional
+
+from quart import g, has_request_context, current_app as app
+
+from rana.errors import NotFound
+from rana.timezones import get_timezone, timezone_table, TimezoneTable
+
+
+class UserContext:
+    """The user a request is working with, loaded once per request."""
+
+    def __init__(self, user: dict):
+        self.user = user
+        self.id = user["id"]
+        self.tz = get_timezone(user["timezone"])
+
+    @property
+    def tz_table(self) -> TimezoneTable:
+        return timezone_table(self.tz)
+
+
+async def _load_context(user_id: uuid.UUID, app_) -> UserContext:
+    user = await app_.db.fetch_user(user_id)
+    if user is None:
+        raise NotFound("User not found")
+
+    return UserContext(user)
+
+
+async def user_context(user_id: uuid.UUID, *, app_=None) -> UserContext:
+    """Return the context of the given user.
+
+    Inside a request, the user is only fetched from the database the
+    first time this is called for them.
+    """
+    app_ = app_ or app
+
+    # background jobs have no request to scope the cache to
+    if not has_request_context():
+        return await _load_context(user_id, app_)
+
+    contexts = g.setdefault("user_contexts", {})
+    ctx: Optional[UserContext] = contexts.get(user_id)
+
+    if ctx is None:
+        ctx = await _load_context(user_id, app_)
+        contexts[user_id] = ctx
+
+    return ctx
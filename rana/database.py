@@ -1,84 +1,130 @@
+import time
 import datetime
 import logging
 import uuid
 import asyncio
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple, Iterable, Dict, List
 
-import pytz
 import asyncpg
 
+from rana.errors import BadRequest
+from rana.utils import LRUCache, TTLCache
+from rana.timezones import get_timezone
+from rana.queries import QUERIES
+from rana.migrations import migrate
+from rana.replicas import ReplicaSet, REPLICA_ERRORS
+
 log = logging.getLogger()
 
+# revoked API keys are sent here, so every process drops them from
+# its cache
+API_KEYS_CHANNEL = "rana_revoked_api_keys"
+
+# seconds to wait before listening on API_KEYS_CHANNEL again
+LISTEN_RETRY_DELAY = 5
+
 
-def timestamp_(tstamp: Optional[int]) -> Optional[str]:
-    """Return a ISO timestamp string from a UNIX timestamp integer."""
+def timestamp_(tstamp: Optional[int]) -> Optional[datetime.datetime]:
+    """Return a datetime from a UNIX timestamp integer."""
     if tstamp is None:
         return None
 
-    dtm = datetime.datetime.fromtimestamp(tstamp)
-    return dtm.isoformat()
+    return datetime.datetime.fromtimestamp(tstamp)
 
 
-def uuid_(identifier: Optional[uuid.UUID]) -> Optional[str]:
-    """Return a json-friendly version of a given UUID string."""
-    if identifier is None:
-        return None
+def heartbeat_simple(row) -> dict:
+    """Return the simple view of a heartbeat out of an
+    (id, entity, type, time, project) row."""
+    return {
+        "id": row[0],
+        "entity": row[1],
+        "type": row[2],
+        "time": row[3],
+        "project": row[4],
+    }
+
+
+def month_partition(year: int, month: int) -> Tuple[str, float, float]:
+    """Return the name, start and end POSIX timestamps of the
+    heartbeats partition for the given (UTC) month."""
+    start = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
 
-    return str(identifier)
+    if month == 12:
+        end = datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc)
+    else:
+        end = datetime.datetime(year, month + 1, 1, tzinfo=datetime.timezone.utc)
 
+    return f"heartbeats_y{year}m{month:02}", start.timestamp(), end.timestamp()
 
-SQL_SETUP_SCRIPT = """
-create table if not exists users (
-    id uuid primary key,
-    username text unique not null,
-    password_hash text not null,
-    timezone text not null default 'Etc/GMT0',
 
-    display_name text default null,
-    website text default null,
+class RanaConnection(asyncpg.Connection):
+    """A pool connection that runs the queries in rana.queries by name,
+    and records how long each query takes."""
 
-    created_at bigint not null,
-    modified_at bigint default null,
+    # set up by Database._setup_connection
+    metrics = None
+    _observed = True
 
-    languages_used_public bool default false not null,
-    logged_time_public bool default false not null,
+    async def _observe(self, query: str, coro):
+        if self.metrics is None or not self._observed:
+            return await coro
 
-    last_heartbeat_at bigint default null,
-    last_plugin text default null,
-    last_plugin_name text default null,
-    last_project text default null
-);
+        started = time.monotonic()
+        res = await coro
+        self.metrics.observe_query(query, time.monotonic() - started, res)
+        return res
 
-create table if not exists api_keys (
-    user_id uuid primary key references users (id),
-    key text not null
-);
+    async def execute(self, query, *args, **kwargs):
+        return await self._observe(query, super().execute(query, *args, **kwargs))
 
-create table if not exists machines (
-    id uuid primary key,
-    user_id uuid references users (id),
-    name text
-);
+    async def fetch(self, query, *args, **kwargs):
+        return await self._observe(query, super().fetch(query, *args, **kwargs))
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._observe(query, super().fetchrow(query, *args, **kwargs))
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._observe(query, super().fetchval(query, *args, **kwargs))
+
+    async def reset(self, *, timeout=None):
+        # pools run this on every release, it isn't one of our queries
+        self._observed = False
+        try:
+            await super().reset(timeout=timeout)
+        finally:
+            self._observed = True
+
+    async def prepare_named(self):
+        """Prepare every query in rana.queries, putting them in the
+        connection's statement cache.
+
+        Statements from prepare() can't outlive a pool checkout, so
+        each query runs once instead, with every argument set to NULL,
+        which gets it into the cache fetch() and friends look up by
+        query text. Nothing it does is kept.
+        """
+        self._observed = False
+        transaction = self.transaction()
+        await transaction.start()
 
-create table if not exists heartbeats (
-    id uuid primary key,
-    user_id uuid references users (id),
-    machine_id uuid references machines (id),
+        try:
+            for query in QUERIES.values():
+                statement = await self.prepare(query)
+                args = [None] * len(statement.get_parameters())
+                await self.fetch(query, *args)
+        finally:
+            await transaction.rollback()
+            self._observed = True
 
-    entity text not null,
-    type text not null,
-    category text default null,
-    time real not null,
-    is_write bool not null default false,
+    async def fetch_named(self, name: str, *args):
+        """Run a query from rana.queries and return the list of rows."""
+        return await self.fetch(QUERIES[name], *args)
 
-    project text default null,
-    branch text default null,
-    language text default null,
-    lines bigint not null,
-    lineno bigint default null,
-    cursorpos bigint default null
-);
-"""
+    async def fetchval_named(self, name: str, *args):
+        """Run a query from rana.queries and return the first value
+        of the row."""
+        return await self.fetchval(QUERIES[name], *args)
 
 
 class Database:
@@ -87,67 +133,404 @@ class Database:
     def __init__(self, app):
         self.app = app
         self.conn = None
+        self.partitions_ahead = app.cfg.getint(
+            "rana", "partitions_ahead", fallback=3
+        )
+        self._partition_task = None
+        self._listen_task = None
+        self._dsn: dict = {}
+
+        # prepared statements don't work behind poolers like pgbouncer
+        # in transaction mode
+        self.prepare_queries = app.cfg.getboolean(
+            "rana", "db_prepare_queries", fallback=True
+        )
+        self.statement_cache_size = app.cfg.getint(
+            "rana", "db_statement_cache_size", fallback=100
+        )
+
+        # reads that can be a few seconds behind go to these
+        self.replicas = ReplicaSet(app)
+
+        # set once the pool is up and the tables exist
+        self.ready = asyncio.Event()
+
+        # (user_id, entity) -> simple view of the latest heartbeat
+        # seen for it, used to reject duplicate heartbeats without
+        # going to the database.
+        self.recent_heartbeats = LRUCache(
+            app.cfg.getint("rana", "dedup_window_size", fallback=10000)
+        )
+
+        # two-way cache of interned_strings
+        string_cache_size = app.cfg.getint(
+            "rana", "string_cache_size", fallback=100000
+        )
+        self.string_ids = LRUCache(string_cache_size)
+        self.strings = LRUCache(string_cache_size)
+
+        # api key -> user id. revoking a key drops it from the cache of
+        # every process, through API_KEYS_CHANNEL. while a process isn't
+        # listening, it relies on the ttl instead.
+        self.api_keys = TTLCache(
+            app.cfg.getint("rana", "api_key_cache_size", fallback=10000),
+            app.cfg.getfloat("rana", "api_key_cache_ttl", fallback=60),
+        )
+
+        # user id -> API view of the user. updating a user drops it from
+        # this process' cache, other processes see the update once the
+        # ttl runs out.
+        self.users = TTLCache(
+            app.cfg.getint("rana", "user_cache_size", fallback=10000),
+            app.cfg.getfloat("rana", "user_cache_ttl", fallback=60),
+        )
+
+        # (user_id, machine name) -> machine id
+        self.machines = LRUCache(
+            app.cfg.getint("rana", "machine_cache_size", fallback=10000)
+        )
+
         asyncio.ensure_future(self.init(app))
 
     async def init(self, app):
-        """Create basic tables."""
-        self.conn = await asyncpg.create_pool(**dict(app.cfg["rana:database"]))
+        """Bring the schema up to date and connect."""
+        dsn = self._dsn = dict(app.cfg["rana:database"])
+
+        # tables must exist before pool connections prepare
+        # their queries
+        setup_conn = await asyncpg.connect(**dsn)
+        try:
+            applied = await migrate(setup_conn)
+        finally:
+            await setup_conn.close()
+
+        if applied:
+            log.info("applied %d migrations", applied)
+
+        # configparser gives an empty string for "db_command_timeout="
+        command_timeout = app.cfg.get("rana", "db_command_timeout", fallback="")
+
+        pool_options = dict(
+            min_size=app.cfg.getint("rana", "db_pool_min_size", fallback=10),
+            max_size=app.cfg.getint("rana", "db_pool_max_size", fallback=10),
+            statement_cache_size=self.statement_cache_size,
+            command_timeout=float(command_timeout) if command_timeout else None,
+            max_inactive_connection_lifetime=app.cfg.getfloat(
+                "rana", "db_connection_lifetime", fallback=300
+            ),
+            connection_class=RanaConnection,
+            init=self._setup_connection,
+        )
+
+        self.conn = await asyncpg.create_pool(**dsn, **pool_options)
+        await self.replicas.connect(**pool_options)
+        self.replicas.start()
         app.conn = self.conn
-        await self.conn.execute(SQL_SETUP_SCRIPT)
+        await self.create_partitions()
+        self._partition_task = asyncio.ensure_future(self._partition_loop())
+        self._listen_task = asyncio.ensure_future(self._listen(await self._listener()))
+        self.ready.set()
+
+    async def _setup_connection(self, conn: "RanaConnection"):
+        conn.metrics = self.app.metrics
+
+        # without a statement cache there's nowhere to keep them
+        if self.prepare_queries and self.statement_cache_size > 0:
+            await conn.prepare_named()
+
+    async def create_partitions(self):
+        """Create the heartbeats partitions for the current month and
+        the configured amount of months after it."""
+        utcnow = datetime.datetime.utcnow()
+        year, month = utcnow.year, utcnow.month
+
+        existing = {
+            row[0]
+            for row in await self.fetch(
+                """
+            select child.relname
+            from pg_inherits
+            join pg_class parent on pg_inherits.inhparent = parent.oid
+            join pg_class child on pg_inherits.inhrelid = child.oid
+            where parent.relname = 'heartbeats'
+            """
+            )
+        }
+
+        for _ in range(self.partitions_ahead + 1):
+            name, start, end = month_partition(year, month)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+            # so that startup runs no DDL when the partitions are there
+            if name in existing:
+                continue
+
+            try:
+                await self.execute(
+                    f"""
+                create table if not exists {name}
+                    partition of heartbeats
+                    for values from ({start}) to ({end})
+                """
+                )
+            except asyncpg.PostgresError:
+                # this happens when heartbeats_default already holds rows
+                # for the month. they must be moved out by hand.
+                log.exception("failed to create partition %r", name)
+
+    async def _partition_loop(self):
+        while True:
+            await asyncio.sleep(86400)
+            await self.create_partitions()
+
+    def _api_key_revoked(self, _conn, _pid, _channel, api_key: str):
+        self.api_keys.pop(api_key)
+
+    async def _listener(self) -> asyncpg.Connection:
+        conn = await asyncpg.connect(**self._dsn)
+        await conn.add_listener(API_KEYS_CHANNEL, self._api_key_revoked)
+
+        # keys revoked while nobody was listening are lost
+        self.api_keys.clear()
+        return conn
+
+    async def _listen(self, conn: asyncpg.Connection):
+        """Keep listening on API_KEYS_CHANNEL, connecting again
+        whenever the given connection is lost."""
+        while True:
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda _conn: lost.set())
+
+            try:
+                await lost.wait()
+            finally:
+                await conn.close()
+
+            log.warning("lost the connection listening for revoked api keys")
+
+            while True:
+                await asyncio.sleep(LISTEN_RETRY_DELAY)
+                try:
+                    conn = await self._listener()
+                    break
+                except (OSError, asyncpg.PostgresError) as err:
+                    log.warning("failed to listen for revoked api keys: %r", err)
 
     async def close(self):
         """Close the database."""
         log.debug("closing db")
+        if self._partition_task is not None:
+            self._partition_task.cancel()
+
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+
+        await self.replicas.close()
+
         if self.conn:
             await self.conn.close()
 
-    async def fetch(self, query, *args):
+    @asynccontextmanager
+    async def _acquire(self, pool, pool_name: str):
+        started = time.monotonic()
+        async with pool.acquire() as conn:
+            self.app.metrics.pool_wait_seconds.observe(
+                time.monotonic() - started, pool=pool_name
+            )
+            yield conn
+
+    async def _read(self, run, replica: bool):
+        """Call run with a connection from a replica, falling back to the
+        primary when replica is false, no replica is usable or the
+        replica fails.
+
+        Only reads that can be a few seconds behind should go to replicas.
+        Anything reading what the same request wrote must not.
+        """
+        pool = self.replicas.pick() if replica else None
+
+        if pool is not None:
+            try:
+                async with self._acquire(pool, "replica") as conn:
+                    res = await run(conn)
+
+                self.replicas.reads += 1
+                return res
+            except REPLICA_ERRORS as err:
+                log.warning("replica read failed, using the primary: %r", err)
+                self.replicas.mark_failed(pool)
+                self.replicas.fallbacks += 1
+
+        async with self._acquire(self.conn, "primary") as conn:
+            return await run(conn)
+
+    async def fetch(self, query, *args, replica: bool = False):
         """Execute a query and return the list of rows."""
-        return await self.conn.fetch(query, *args)
+        return await self._read(lambda conn: conn.fetch(query, *args), replica)
 
-    async def fetchrow(self, query, *args):
+    async def fetchrow(self, query, *args, replica: bool = False):
         """Execute a query and return a single result row."""
-        return await self.conn.fetchrow(query, *args)
+        return await self._read(lambda conn: conn.fetchrow(query, *args), replica)
 
-    async def fetchval(self, query, *args):
+    async def fetchval(self, query, *args, replica: bool = False):
         """Execute a query and return the first value of the row."""
-        return await self.conn.fetchval(query, *args)
+        return await self._read(lambda conn: conn.fetchval(query, *args), replica)
 
     async def execute(self, query, *args):
         """Execute SQL."""
-        return await self.conn.execute(query, *args)
+        async with self._acquire(self.conn, "primary") as conn:
+            return await conn.execute(query, *args)
+
+    async def fetch_named(self, name: str, *args, replica: bool = False):
+        """Run a query from rana.queries and return the list of rows."""
+        return await self._read(lambda conn: conn.fetch_named(name, *args), replica)
+
+    async def fetchval_named(self, name: str, *args, replica: bool = False):
+        """Run a query from rana.queries and return the first value
+        of the row."""
+        return await self._read(lambda conn: conn.fetchval_named(name, *args), replica)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Acquire a connection from the pool and yield it inside
+        a transaction."""
+        async with self._acquire(self.conn, "primary") as conn:
+            async with conn.transaction():
+                yield conn
+
+    def _cache_string(self, string_id: int, value: str):
+        self.string_ids.set(value, string_id)
+        self.strings.set(string_id, value)
+
+    async def intern(self, values: Iterable[Optional[str]]) -> Dict[str, int]:
+        """Return the interned string ids of the given strings, creating
+        them if needed. None values are skipped."""
+        values = {value for value in values if value is not None}
+        ids: Dict[str, int] = {}
+        missing = []
+
+        for value in values:
+            string_id = self.string_ids.get(value)
+            if string_id is None:
+                missing.append(value)
+            else:
+                ids[value] = string_id
+
+        # other connections may be inserting the same strings, and the
+        # select doesn't see rows they haven't committed yet, so we try
+        # again for whatever we didn't get. they committed by then, so
+        # anything still missing has the same md5 as another string.
+        for _ in range(2):
+            if not missing:
+                break
+
+            rows = await self.fetch(
+                """
+            with new as (
+                insert into interned_strings (value)
+                select value from unnest($1::text[]) as value order by value
+                on conflict (md5(value)) do nothing
+                returning id, value
+            )
+            select id, value from new
+            union all
+            select id, value from interned_strings
+            where md5(value) in (select md5(value) from unnest($1::text[]) as value)
+              and value = any($1::text[])
+            """,
+                sorted(missing),
+            )
+
+            for string_id, value in rows:
+                self._cache_string(string_id, value)
+                ids[value] = string_id
+
+            missing = [value for value in missing if value not in ids]
+
+        if missing:
+            raise BadRequest(f"can't store {len(missing)} colliding strings")
+
+        return ids
+
+    async def resolve(self, string_ids: Iterable[Optional[int]]) -> Dict[int, str]:
+        """Return the strings for the given interned string ids.
+        None values are skipped."""
+        string_ids = {string_id for string_id in string_ids if string_id is not None}
+        values: Dict[int, str] = {}
+        missing = []
+
+        for string_id in string_ids:
+            value = self.strings.get(string_id)
+            if value is None:
+                missing.append(string_id)
+            else:
+                values[string_id] = value
+
+        if missing:
+            rows = await self.fetch(
+                """
+            select id, value from interned_strings where id = any($1::int[])
+            """,
+                missing,
+            )
+
+            for string_id, value in rows:
+                self._cache_string(string_id, value)
+                values[string_id] = value
+
+        return values
+
+    async def resolve_keys(self, items: List[dict], *keys: str) -> List[dict]:
+        """Replace the interned string ids in the given keys of each
+        item with their strings, in place."""
+        values = await self.resolve(item[key] for item in items for key in keys)
+
+        for item in items:
+            for key in keys:
+                item[key] = values.get(item[key])
+
+        return items
+
+    async def fetch_api_key_user(self, api_key: str) -> Optional[uuid.UUID]:
+        """Return the ID of the user owning the given API key."""
+        user_id = self.api_keys.get(api_key)
+        if user_id is not None:
+            return user_id
+
+        user_id = await self.fetchval_named("api_key_user", api_key)
+
+        if user_id is not None:
+            self.api_keys.set(api_key, user_id)
+
+        return user_id
+
+    async def revoke_api_key(self, api_key: str, new_api_key: str):
+        """Replace an API key with a new one. Every process stops
+        accepting the old key once this returns, save for the ones
+        not listening on API_KEYS_CHANNEL."""
+        async with self.transaction() as conn:
+            await conn.execute(
+                """
+            update api_keys set key = $2 where key = $1
+            """,
+                api_key,
+                new_api_key,
+            )
+
+            # sent when the transaction commits
+            await conn.execute("select pg_notify($1, $2)", API_KEYS_CHANNEL, api_key)
+
+        self.api_keys.pop(api_key)
 
     async def fetch_user_tz(self, user_id: uuid.UUID):
         """Fetch a user's configured timezone."""
-        olson_tz = await self.fetchval(
-            "select timezone from users where id = $1", user_id
-        )
-
-        if not olson_tz:
-            return pytz.timezone("UTC")
-
-        return pytz.timezone(olson_tz)
-
-    async def fetch_user(self, user_id: uuid.UUID) -> Optional[dict]:
-        """Fetch a single user and return the dictionary
-        representing the API view of them.
-        """
-        row = await self.fetchrow(
-            """
-        select
-            id, username, display_name, website, created_at, modified_at,
-            last_heartbeat_at, last_plugin, last_plugin_name, last_project,
-            timezone
-        from users where id = $1
-        """,
-            user_id,
-        )
-
-        if not row:
-            return None
+        user = await self.fetch_user(user_id)
+        return get_timezone(user["timezone"] if user else None)
 
+    @staticmethod
+    def _user_view(row) -> dict:
         user = {
-            "id": uuid_(row[0]),
+            "id": row[0],
             "username": row[1],
             # no "full legal names" here uwuwuwuwu
             # trans rights
@@ -180,34 +563,89 @@ class Database:
 
         return user
 
-    async def fetch_user_simple(self, user_id: uuid.UUID) -> Optional[dict]:
-        """Fetch a single simple view user."""
-        row = await self.fetchrow(
+    async def _fetch_users(
+        self, user_ids: Iterable[uuid.UUID]
+    ) -> Dict[uuid.UUID, dict]:
+        """Return the cached API views of the given users, fetching
+        the ones that aren't cached.
+
+        Users that don't exist are missing from the result. The views
+        are shared, callers must copy them before changing them.
+        """
+        users = {}
+        missing = []
+
+        for user_id in set(user_ids):
+            user = self.users.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+
+        if not missing:
+            return users
+
+        rows = await self.fetch(
             """
         select
-            id, username, display_name, website
-        from users where id = $1
+            id, username, display_name, website, created_at, modified_at,
+            last_heartbeat_at, last_plugin, last_plugin_name, last_project,
+            timezone
+        from users where id = any($1::uuid[])
         """,
-            user_id,
+            missing,
         )
 
-        if not row:
-            return None
+        for row in rows:
+            user = self._user_view(row)
+            self.users.set(row[0], user)
+            users[row[0]] = user
+
+        return users
+
+    def invalidate_user(self, user_id: uuid.UUID):
+        """Drop a user from this process' cache. Anything that updates
+        the users table must call this."""
+        self.users.pop(user_id)
+
+    async def fetch_user(self, user_id: uuid.UUID) -> Optional[dict]:
+        """Fetch a single user and return the dictionary
+        representing the API view of them.
+        """
+        user = (await self._fetch_users([user_id])).get(user_id)
+        return None if user is None else dict(user)
 
+    @staticmethod
+    def _user_simple(user: dict) -> dict:
         return {
-            "id": uuid_(row[0]),
-            "username": row[1],
-            "display_name": row[2],
-            "website": row[3],
+            "id": user["id"],
+            "username": user["username"],
+            "display_name": user["display_name"],
+            "website": user["website"],
         }
 
+    async def fetch_user_simple(self, user_id: uuid.UUID) -> Optional[dict]:
+        """Fetch a single simple view user."""
+        user = (await self._fetch_users([user_id])).get(user_id)
+        return None if user is None else self._user_simple(user)
+
+    async def fetch_users_simple(
+        self, user_ids: Iterable[uuid.UUID]
+    ) -> Dict[uuid.UUID, dict]:
+        """Fetch many simple view users at once, by their IDs.
+
+        Users that don't exist are missing from the result.
+        """
+        users = await self._fetch_users(user_ids)
+        return {user_id: self._user_simple(user) for user_id, user in users.items()}
+
     async def fetch_heartbeat(self, heartbeat_id: uuid.UUID) -> Optional[dict]:
         """Fetch a single heartbeat."""
         # TODO: complete this query with all columns from heartbeats table.
         row = await self.fetchrow(
             """
         select
-            id, entity, type, category, time, project, language
+            id, entity_id, type_id, category_id, time, project_id, language_id
         from heartbeats where id = $1
         """,
             heartbeat_id,
@@ -217,7 +655,7 @@ class Database:
             return None
 
         heartbeat = {
-            "id": uuid_(row[0]),
+            "id": row[0],
             "entity": row[1],
             "type": row[2],
             "category": row[3],
@@ -226,6 +664,9 @@ class Database:
             "language": row[6],
         }
 
+        await self.resolve_keys(
+            [heartbeat], "entity", "type", "category", "project", "language"
+        )
         return heartbeat
 
     async def fetch_heartbeat_simple(self, heartbeat_id: uuid.UUID) -> Optional[dict]:
@@ -233,7 +674,7 @@ class Database:
         row = await self.fetchrow(
             """
         select
-            id, entity, type, time, project
+            id, entity_id, type_id, time, project_id
         from heartbeats where id = $1
         """,
             heartbeat_id,
@@ -242,12 +683,6 @@ class Database:
         if not row:
             return None
 
-        heartbeat = {
-            "id": uuid_(row[0]),
-            "entity": row[1],
-            "type": row[2],
-            "time": row[3],
-            "project": row[4],
-        }
-
+        heartbeat = heartbeat_simple(row)
+        await self.resolve_keys([heartbeat], "entity", "type", "project")
         return heartbeat
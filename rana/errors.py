@@ -8,6 +8,11 @@ class RanaError(Exception):
         """Return the error message for the given error."""
         return self.args[0]
 
+    @property
+    def headers(self):
+        """Return extra headers to send with the error response."""
+        return {}
+
 
 class BadRequest(RanaError):
     status_code = 400
@@ -19,3 +24,27 @@ class Unauthorized(RanaError):
 
 class Forbidden(RanaError):
     status_code = 403
+
+
+class NotFound(RanaError):
+    status_code = 404
+
+
+class PayloadTooLarge(RanaError):
+    status_code = 413
+
+
+class UnsupportedMediaType(RanaError):
+    status_code = 415
+
+
+class ServiceUnavailable(RanaError):
+    status_code = 503
+
+    def __init__(self, message, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)}
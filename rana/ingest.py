@@ -0,0 +1,214 @@
+import time
+import uuid
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, List, Dict, Tuple
+
+from rana.errors import ServiceUnavailable
+from rana.database import heartbeat_simple
+from rana.blueprints.heartbeats import process_many_hbs
+
+log = logging.getLogger(__name__)
+
+# seconds between attempts at inserting heartbeats that failed, at most
+MAX_RETRY_DELAY = 60.0
+
+
+class IngestQueue:
+    """Write-behind queue for heartbeats.
+
+    Heartbeats are validated by the request handlers and put on the
+    queue, and a background task inserts them in bulk once the queue
+    reaches the batch size, or once the flush interval passes.
+
+    Heartbeats that fail to be inserted are tried again, waiting twice
+    as long each time, up to ingest_max_retries times. Then they're
+    dropped and counted.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        self.max_depth = app.cfg.getint("rana", "ingest_queue_size", fallback=10000)
+        self.batch_size = app.cfg.getint("rana", "ingest_batch_size", fallback=500)
+        self.flush_interval = app.cfg.getfloat(
+            "rana", "ingest_flush_interval", fallback=1.0
+        )
+        self.max_retries = app.cfg.getint("rana", "ingest_max_retries", fallback=5)
+
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+        # (retry at, attempts so far, user id, machine id, heartbeats)
+        self._retries: List[Tuple[float, int, Any, Any, List[dict]]] = []
+
+        # counters
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flushed_heartbeats = 0
+        self.retried_heartbeats = 0
+        self.dropped_heartbeats = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        """Amount of heartbeats waiting to be inserted."""
+        retrying = sum(len(retry[4]) for retry in self._retries)
+        return self.queue.qsize() + retrying
+
+    def start(self):
+        """Start the background flusher."""
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop the background flusher and insert whatever is left
+        on the queue, giving failed heartbeats one last try."""
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        await self.flush(final=True)
+
+    def put_many(self, user_id, machine_id, heartbeats: List[dict]) -> List[dict]:
+        """Put validated heartbeats on the queue.
+
+        Returns the simple view of each heartbeat. Raises
+        ServiceUnavailable if the queue can't fit them.
+        """
+        if self.depth + len(heartbeats) > self.max_depth:
+            raise ServiceUnavailable(
+                "ingest queue is full", retry_after=max(1, int(self.flush_interval))
+            )
+
+        res = []
+        for heartbeat in heartbeats:
+            heartbeat["id"] = uuid.uuid4()
+            self.queue.put_nowait((user_id, machine_id, heartbeat))
+
+            res.append(
+                heartbeat_simple(
+                    (
+                        heartbeat["id"],
+                        heartbeat["entity"],
+                        heartbeat["type"],
+                        heartbeat["time"],
+                        heartbeat["project"],
+                    )
+                )
+            )
+
+        if self.depth >= self.batch_size:
+            self._batch_ready.set()
+
+        return res
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._batch_ready.clear()
+            await self.flush()
+
+    def _take_batch(self) -> List[Tuple]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        return batch
+
+    async def flush(self, *, final: bool = False):
+        """Insert all queued heartbeats, one batch at a time, and
+        retry the failed ones that are due.
+
+        On the final flush, every failed heartbeat is retried right
+        away, and dropped if it fails again.
+        """
+        async with self._flush_lock:
+            now = time.monotonic()
+            due, waiting = [], []
+            for retry in self._retries:
+                (due if final or retry[0] <= now else waiting).append(retry)
+
+            self._retries = waiting
+
+            for _, attempts, user_id, machine_id, heartbeats in due:
+                self.retried_heartbeats += len(heartbeats)
+                await self._insert(user_id, machine_id, heartbeats, attempts, final)
+
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return
+
+                await self._flush_batch(batch, final)
+
+    async def _insert(
+        self, user_id, machine_id, heartbeats: List[dict], attempts: int, final: bool
+    ):
+        try:
+            await process_many_hbs(user_id, machine_id, heartbeats, app_=self.app)
+        except Exception:
+            self.flush_errors += 1
+            attempts += 1
+
+            if final or attempts > self.max_retries:
+                self.dropped_heartbeats += len(heartbeats)
+                log.exception(
+                    "dropping %d heartbeats for uid %r after %d attempts",
+                    len(heartbeats),
+                    user_id,
+                    attempts,
+                )
+                return
+
+            delay = min(self.flush_interval * 2**attempts, MAX_RETRY_DELAY)
+            self._retries.append(
+                (time.monotonic() + delay, attempts, user_id, machine_id, heartbeats)
+            )
+            log.exception(
+                "failed to insert %d heartbeats for uid %r, retrying in %.1fs",
+                len(heartbeats),
+                user_id,
+                delay,
+            )
+            return
+
+        self.flushed_heartbeats += len(heartbeats)
+
+    async def _flush_batch(self, batch: List[Tuple], final: bool):
+        # process_many_hbs works on a single (user, machine) pair
+        groups: Dict[Tuple, List[dict]] = defaultdict(list)
+        for user_id, machine_id, heartbeat in batch:
+            groups[(user_id, machine_id)].append(heartbeat)
+
+        start = time.monotonic()
+
+        for (user_id, machine_id), heartbeats in groups.items():
+            await self._insert(user_id, machine_id, heartbeats, 0, final)
+
+        latency = time.monotonic() - start
+
+        self.flushes += 1
+        self.last_flush_latency = latency
+        self.total_flush_latency += latency
+
+        log.debug(
+            "flushed %d heartbeats in %.3fs, %d left",
+            len(batch),
+            latency,
+            self.depth,
+        )
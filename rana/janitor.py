@@ -0,0 +1,242 @@
+import re
+import time
+import asyncio
+import logging
+import datetime
+from typing import Any, Tuple
+
+from rana.database import month_partition
+
+log = logging.getLogger(__name__)
+
+PARTITION_REGEX = re.compile(r"^heartbeats_y(\d{4})m(\d{2})$")
+
+# the subqueries walk heartbeats_time_idx and durations_ended_idx
+DELETE_HEARTBEATS = """
+delete from heartbeats
+where (id, time) in (
+    select id, time from heartbeats
+    where time < $1
+    limit $2
+)
+"""
+
+DELETE_DURATIONS = """
+delete from durations
+where id in (
+    select id from durations
+    where ended_at < $1
+    limit $2
+)
+"""
+
+# the summaries of purged days. rollups without their rollup_days row
+# are calculated again, from whatever durations are left, if asked for.
+DELETE_ROLLUP_DAYS = """
+delete from rollup_days
+where ctid = any(array(
+    select ctid from rollup_days
+    where day < $1
+    limit $2
+))
+"""
+
+DELETE_DAILY_ROLLUPS = """
+delete from daily_rollups
+where ctid = any(array(
+    select ctid from daily_rollups
+    where day < $1
+    limit $2
+))
+"""
+
+# same for leaderboard days, see LeaderboardWindow.sync
+DELETE_LEADERBOARD_DAYS = """
+delete from leaderboard_days
+where ctid = any(array(
+    select ctid from leaderboard_days
+    where day < $1
+    limit $2
+))
+"""
+
+DELETE_LEADERBOARD_BUCKETS = """
+delete from leaderboard_buckets
+where ctid = any(array(
+    select ctid from leaderboard_buckets
+    where day < $1
+    limit $2
+))
+"""
+
+
+class DataJanitor:
+    """Background job that removes heartbeats older than
+    data_janitor_limit days, along with what was calculated from them.
+
+    Monthly partitions that are entirely past the limit are detached
+    and dropped. What's left is deleted in small chunks, so that no
+    transaction holds locks for long. Each cycle stops once it has
+    spent data_janitor_runtime seconds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        # configparser gives an empty string for "data_janitor_limit="
+        limit = app.cfg.get("rana", "data_janitor_limit", fallback="")
+        self.limit_days = int(limit) if limit else 0
+        self.runtime = app.cfg.getfloat("rana", "data_janitor_runtime", fallback=30)
+        self.interval = app.cfg.getfloat(
+            "rana", "data_janitor_interval", fallback=3600
+        )
+        self.chunk_size = app.cfg.getint("rana", "data_janitor_chunk", fallback=1000)
+
+        # pause between chunks so autovacuum and other queries
+        # can keep up with the deletes
+        self.chunk_pause = 0.05
+
+        self._task = None
+
+        # counters
+        self.cycles = 0
+        self.rows_removed = 0
+        self.partitions_dropped = 0
+        self.time_spent = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit_days > 0
+
+    def start(self):
+        """Start the background job."""
+        if not self.enabled:
+            log.info("data janitor is disabled")
+            return
+
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop the background job."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        await self.app.db.ready.wait()
+
+        while True:
+            try:
+                await self.run_cycle()
+            except Exception:
+                log.exception("data janitor cycle failed")
+
+            await asyncio.sleep(self.interval)
+
+    async def run_cycle(self) -> Tuple[int, float]:
+        """Run a single cleanup cycle.
+
+        Returns the amount of removed rows and the time spent.
+        """
+        cutoff = time.time() - (self.limit_days * 86400)
+        start = time.monotonic()
+        deadline = start + self.runtime
+
+        dropped_rows = await self._drop_partitions(cutoff, deadline)
+        deleted_rows = await self._delete_chunks(DELETE_HEARTBEATS, cutoff, deadline)
+
+        # durations are derived from heartbeats, so they follow
+        # the same retention
+        await self._delete_chunks(DELETE_DURATIONS, cutoff, deadline)
+
+        # days are local to each user, up to 14 hours off UTC, so days
+        # around the cutoff go too and are calculated again
+        cutoff_day = datetime.datetime.utcfromtimestamp(cutoff).date()
+        for query in (
+            DELETE_ROLLUP_DAYS,
+            DELETE_DAILY_ROLLUPS,
+            DELETE_LEADERBOARD_DAYS,
+            DELETE_LEADERBOARD_BUCKETS,
+        ):
+            await self._delete_chunks(
+                query, cutoff_day + datetime.timedelta(days=2), deadline
+            )
+
+        removed = dropped_rows + deleted_rows
+        elapsed = time.monotonic() - start
+
+        self.cycles += 1
+        self.rows_removed += removed
+        self.time_spent += elapsed
+
+        log.info("data janitor: removed %d heartbeats in %.2fs", removed, elapsed)
+        return removed, elapsed
+
+    async def _drop_partitions(self, cutoff: float, deadline: float) -> int:
+        """Drop the monthly partitions that only hold heartbeats
+        older than the cutoff. Returns about how many rows they had,
+        going by the table statistics."""
+        db = self.app.db
+        partitions = await db.fetch(
+            """
+        select child.relname
+        from pg_inherits
+        join pg_class parent on pg_inherits.inhparent = parent.oid
+        join pg_class child on pg_inherits.inhrelid = child.oid
+        where parent.relname = 'heartbeats'
+        """
+        )
+
+        removed = 0
+
+        for (name,) in sorted(partitions):
+            if time.monotonic() >= deadline:
+                break
+
+            match = PARTITION_REGEX.match(name)
+            if match is None:
+                continue
+
+            _, _, end = month_partition(int(match.group(1)), int(match.group(2)))
+            if end > cutoff:
+                continue
+
+            # counting the rows would scan the whole partition
+            rows = await db.fetchval(
+                """
+            select greatest(reltuples, 0)::bigint
+            from pg_class
+            where oid = $1::regclass
+            """,
+                name,
+            )
+
+            async with db.transaction() as conn:
+                await conn.execute(f"alter table heartbeats detach partition {name}")
+                await conn.execute(f"drop table {name}")
+
+            log.info("data janitor: dropped partition %r (~%d rows)", name, rows)
+            self.partitions_dropped += 1
+            removed += rows
+
+        return removed
+
+    async def _delete_chunks(self, query: str, cutoff: Any, deadline: float) -> int:
+        """Delete old rows with the given query a chunk at a time until
+        none are left or the deadline passes. Returns the amount of
+        deleted rows."""
+        removed = 0
+
+        while time.monotonic() < deadline:
+            # each delete is its own short transaction
+            res = await self.app.db.execute(query, cutoff, self.chunk_size)
+
+            # asyncpg gives us the command tag, "DELETE <count>"
+            deleted = int(res.split()[-1])
+            removed += deleted
+
+            if deleted < self.chunk_size:
+                break
+
+            await asyncio.sleep(self.chunk_pause)
+
+        return removed
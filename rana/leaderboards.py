@@ -0,0 +1,385 @@
+import time
+import asyncio
+import logging
+import datetime
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+TimeRange = Tuple[datetime.datetime, datetime.datetime]
+
+
+class LeaderboardSnapshot:
+    """A leaderboard, as calculated at modified_at."""
+
+    def __init__(self, time_range: TimeRange, leader_data: dict, modified_at: float):
+        self.time_range = time_range
+        self.leader_data = leader_data
+        self.modified_at = modified_at
+
+        self.global_rank = {
+            user_id: sum(val for _, val in lang_counter.most_common())
+            for user_id, lang_counter in leader_data.items()
+        }
+
+        # most active first. ties go by user id so that pages
+        # don't shuffle between refreshes
+        self.sorted_leaders = sorted(
+            self.global_rank.keys(),
+            key=lambda uid: (-self.global_rank[uid], str(uid)),
+        )
+        self.ranks = {uid: idx + 1 for idx, uid in enumerate(self.sorted_leaders)}
+
+    def __len__(self) -> int:
+        return len(self.sorted_leaders)
+
+    def rank(self, user_id) -> Optional[int]:
+        """Return the rank of the given user, starting at 1, or None
+        if they aren't in the leaderboard."""
+        return self.ranks.get(user_id)
+
+
+# the leaderboards cover this many days, up to the start of the
+# current UTC day
+WINDOW_DAYS = 7
+
+ONE_DAY = datetime.timedelta(days=1)
+
+Bucket = Dict[Tuple[Any, Optional[int]], float]
+
+
+def _day_bounds(day: datetime.date) -> Tuple[float, float]:
+    start = datetime.datetime(
+        day.year, day.month, day.day, tzinfo=datetime.timezone.utc
+    ).timestamp()
+    return start, start + 86400
+
+
+# leaderboard days are locked with the two-key advisory lock functions,
+# this key and the day number, so they can't clash with other locks
+DAYS_LOCK_KEY = 0x6C656164
+
+EPOCH_DAY = datetime.date(2000, 1, 1)
+
+
+async def mark_days_stale(conn, start: float, end: float):
+    """Mark the leaderboard days touched by the given span (in UTC)
+    as stale.
+
+    Must run in the transaction that changed the durations.
+    """
+    start_day = datetime.datetime.utcfromtimestamp(start).date()
+    end_day = datetime.datetime.utcfromtimestamp(end).date()
+
+    # days being calculated only start after we commit, including days
+    # that don't have a row yet. the lock is shared, so heartbeats don't
+    # wait for each other. days outside of any window (give or take a
+    # day of clock skew) won't be calculated before we commit.
+    today = datetime.datetime.utcnow().date()
+    await conn.execute(
+        """
+    select pg_advisory_xact_lock_shared($1, day::date - $2::date)
+    from generate_series($3::date, $4::date, interval '1 day') as day
+    """,
+        DAYS_LOCK_KEY,
+        EPOCH_DAY,
+        max(start_day, today - ONE_DAY * (WINDOW_DAYS + 1)),
+        min(end_day, today + ONE_DAY),
+    )
+
+    await conn.execute(
+        """
+    update leaderboard_days
+    set stale = true, generation = generation + 1
+    where day >= $1 and day <= $2 and not stale
+    """,
+        start_day,
+        end_day,
+    )
+
+
+class LeaderboardWindow:
+    """Per-user, per-language seconds of the last WINDOW_DAYS UTC days,
+    kept as one bucket per day.
+
+    Buckets of closed days are calculated once and kept in the
+    leaderboard_buckets table. Heartbeats arriving for those days mark
+    them as stale so they are calculated again, and the oldest bucket
+    is dropped once a new day starts.
+    """
+
+    def __init__(self, days: int = WINDOW_DAYS):
+        self.days = days
+        self.buckets: Dict[datetime.date, Bucket] = {}
+
+        # generation of each bucket's day, as of when it was read. other
+        # processes recalculating a day bump it.
+        self.generations: Dict[datetime.date, int] = {}
+
+    def window(self, today: datetime.date) -> List[datetime.date]:
+        """Return the days in the window that ends at the given day."""
+        return [today - ONE_DAY * idx for idx in range(self.days, 0, -1)]
+
+    async def _calc_bucket(self, db, day: datetime.date) -> Tuple[Bucket, int]:
+        async with db.transaction() as conn:
+            # waits for the heartbeats that touched the day
+            await conn.execute(
+                """
+            select pg_advisory_xact_lock($1, $2::date - $3::date)
+            """,
+                DAYS_LOCK_KEY,
+                day,
+                EPOCH_DAY,
+            )
+
+            # heartbeats from now on make the day stale again
+            generation = await conn.fetchval(
+                """
+            insert into leaderboard_days (day, stale)
+            values ($1, false)
+            on conflict (day) do update set stale = false
+            returning generation
+            """,
+                day,
+            )
+
+        start, end = _day_bounds(day)
+        rows = await db.fetch(
+            """
+        select user_id, language_id,
+               sum(least(ended_at, $2) - greatest(started_at, $1))
+        from durations
+        where ended_at > $1 and started_at < $2
+        group by user_id, language_id
+        """,
+            start,
+            end,
+        )
+
+        async with db.transaction() as conn:
+            current = await conn.fetchval(
+                """
+            select generation from leaderboard_days where day = $1 for update
+            """,
+                day,
+            )
+
+            # the day went stale while we were at it, and whoever
+            # calculates it next has newer durations than ours
+            if current == generation:
+                await conn.execute(
+                    """
+                delete from leaderboard_buckets where day = $1
+                """,
+                    day,
+                )
+
+                await conn.execute(
+                    """
+                insert into leaderboard_buckets (day, user_id, language_id,
+                    total_seconds)
+                select $1, b.user_id, b.language_id, b.total_seconds
+                from unnest($2::uuid[], $3::int[], $4::float8[])
+                    as b(user_id, language_id, total_seconds)
+                """,
+                    day,
+                    [row[0] for row in rows],
+                    [row[1] for row in rows],
+                    [row[2] for row in rows],
+                )
+
+        return {(row[0], row[1]): row[2] for row in rows}, generation
+
+    async def _load_bucket(self, db, day: datetime.date) -> Bucket:
+        rows = await db.fetch(
+            """
+        select user_id, language_id, total_seconds
+        from leaderboard_buckets
+        where day = $1
+        """,
+            day,
+        )
+
+        return {(row[0], row[1]): row[2] for row in rows}
+
+    async def sync(self, db, today: datetime.date) -> int:
+        """Move the window to end at the given day, calculating the
+        buckets that are stale or missing. Returns how many buckets
+        were calculated."""
+        days = self.window(today)
+
+        for day in list(self.buckets):
+            if day not in days:
+                self.buckets.pop(day)
+                self.generations.pop(day, None)
+
+        rows = await db.fetch(
+            """
+        select day, generation from leaderboard_days
+        where day = any($1::date[]) and not stale
+        """,
+            days,
+        )
+        fresh = {row[0]: row[1] for row in rows}
+
+        calculated = 0
+        for day in days:
+            if day not in fresh:
+                bucket, generation = await self._calc_bucket(db, day)
+                self.buckets[day] = bucket
+                self.generations[day] = generation
+                calculated += 1
+            elif self.generations.get(day) != fresh[day]:
+                # new, or calculated again by another process
+                self.buckets[day] = await self._load_bucket(db, day)
+                self.generations[day] = fresh[day]
+
+        # nobody needs the days that left the window
+        await db.execute(
+            """
+        delete from leaderboard_buckets where day < $1
+        """,
+            days[0],
+        )
+        await db.execute(
+            """
+        delete from leaderboard_days where day < $1
+        """,
+            days[0],
+        )
+
+        return calculated
+
+    def totals(self) -> Bucket:
+        """Return the seconds of each user and language over
+        the whole window."""
+        totals: Counter = Counter()
+        for bucket in self.buckets.values():
+            totals.update(bucket)
+
+        return totals
+
+
+async def calc_leaders(
+    app, window: LeaderboardWindow
+) -> Tuple[TimeRange, Dict[Optional[str], dict]]:
+    """Calculate the global leaderboard and the leaderboard of each
+    language, out of the last 7 (UTC) days of durations.
+
+    The global leaderboard's key is None.
+    """
+    utcnow = datetime.datetime.utcnow()
+
+    # remove hour/minute/second
+    utcnow = datetime.datetime(year=utcnow.year, month=utcnow.month, day=utcnow.day)
+
+    start = utcnow - datetime.timedelta(days=window.days)
+    end = utcnow
+
+    calculated = await window.sync(app.db, utcnow.date())
+
+    totals = [
+        {"user_id": user_id, "language": language_id, "total_seconds": seconds}
+        for (user_id, language_id), seconds in window.totals().items()
+    ]
+    await app.db.resolve_keys(totals, "language")
+
+    leaders: Dict[Optional[str], dict] = defaultdict(lambda: defaultdict(Counter))
+
+    for total in totals:
+        user_id = total["user_id"]
+        lang = total["language"]
+        seconds = total["total_seconds"]
+
+        leaders[None][user_id][lang or "Other"] += seconds
+        if lang is not None:
+            leaders[lang][user_id][lang] += seconds
+
+    log.debug("%d days calculated, %d leaderboards", calculated, len(leaders))
+    return (start, end), leaders
+
+
+class LeaderboardRefresher:
+    """Background job that calculates the leaderboards every
+    leaders_refresh_interval seconds, so that requests only
+    read them."""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.cfg.getfloat(
+            "rana", "leaders_refresh_interval", fallback=600
+        )
+
+        self.window = LeaderboardWindow()
+        self.snapshots: Dict[Optional[str], LeaderboardSnapshot] = {}
+        self.time_range: Optional[TimeRange] = None
+        self.modified_at: Optional[float] = None
+
+        self._lock = asyncio.Lock()
+        self._task = None
+
+        # counters
+        self.refreshes = 0
+        self.last_refresh_time = 0.0
+
+    def start(self):
+        """Start the background job."""
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop the background job."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        await self.app.db.ready.wait()
+
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception("leaderboard refresh failed")
+
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        """Calculate all leaderboards and replace the current ones."""
+        async with self._lock:
+            await self._refresh()
+
+    async def _refresh(self):
+        started = time.monotonic()
+        time_range, leaders = await calc_leaders(self.app, self.window)
+        modified_at = time.time()
+
+        self.snapshots = {
+            language: LeaderboardSnapshot(time_range, leader_data, modified_at)
+            for language, leader_data in leaders.items()
+        }
+        self.time_range = time_range
+        self.modified_at = modified_at
+
+        self.refreshes += 1
+        self.last_refresh_time = time.monotonic() - started
+
+        log.info(
+            "leaderboards: refreshed %d in %.2fs",
+            len(self.snapshots),
+            self.last_refresh_time,
+        )
+
+    async def fetch(self, language: Optional[str] = None) -> LeaderboardSnapshot:
+        """Return the leaderboard of the given language, or the global
+        one. Languages without any activity get an empty leaderboard."""
+        # the first requests can come before the job's first run
+        if self.modified_at is None:
+            async with self._lock:
+                if self.modified_at is None:
+                    await self._refresh()
+
+        snapshot = self.snapshots.get(language)
+        if snapshot is None:
+            return LeaderboardSnapshot(self.time_range, {}, self.modified_at)
+
+        return snapshot
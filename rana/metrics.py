@@ -0,0 +1,405 @@
+import re
+import abc
+import bisect
+import logging
+import functools
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from rana.queries import QUERIES
+
+log = logging.getLogger(__name__)
+
+# seconds. covers a cache-hot primary key lookup up to a leaderboard
+# calculation
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# (labels, value) pairs of a metric
+Samples = Iterable[Tuple[Dict[str, str], float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    pairs = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    """A metric with a value for each combination of labels."""
+
+    type_ = "untyped"
+
+    def __init__(self, name: str, help_: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> List[str]:
+        """Return the lines of the metric, in the Prometheus text
+        format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}"
+            )
+
+        return lines
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        """Yield the (suffix, labels, value) of each sample."""
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type_ = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield "", self._labels(key), value
+
+
+class Gauge(Metric):
+    """A value read from the app when the metrics are rendered."""
+
+    type_ = "gauge"
+
+    def __init__(self, name: str, help_: str, labelnames, read: Callable[[], Samples]):
+        super().__init__(name, help_, labelnames)
+        self.read = read
+
+    def samples(self):
+        for labels, value in self.read():
+            yield "", labels, value
+
+
+class CounterView(Gauge):
+    """A counter kept by some other object, like a background job."""
+
+    type_ = "counter"
+
+
+class Histogram(Metric):
+    """Counts of observed values, by bucket."""
+
+    type_ = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+        # labels -> [count of each bucket, count, sum]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            state[0][idx] += 1
+
+        state[1] += 1
+        state[2] += value
+
+    def samples(self):
+        for key, (bucket_counts, count, total) in self.values.items():
+            labels = self._labels(key)
+
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+
+            yield "_bucket", {**labels, "le": "+Inf"}, count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+QUERY_NAMES = {query: name for name, query in QUERIES.items()}
+
+TABLE_REGEX = re.compile(r"\b(?:from|into|update|join)\s+(\w+)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def query_name(query: str) -> str:
+    """Return a short name for a query, to label its metrics with.
+
+    Queries from rana.queries go by their name, anything else by its
+    first word and the first table it mentions, like "select durations".
+    """
+    name = QUERY_NAMES.get(query)
+    if name is not None:
+        return name
+
+    words = query.split(maxsplit=1)
+    if not words:
+        return "empty"
+
+    verb = words[0].lower()
+    match = TABLE_REGEX.search(query)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def row_count(result) -> int:
+    """Return how many rows a fetch() or execute() result stands for."""
+    if result is None:
+        return 0
+
+    if isinstance(result, list):
+        return len(result)
+
+    # command tags, like "INSERT 0 5" or "DELETE 3"
+    if isinstance(result, str):
+        last = result.rsplit(" ", 1)[-1]
+        return int(last) if last.isdigit() else 0
+
+    return 1
+
+
+def _one(value: Optional[float]) -> Samples:
+    return [] if value is None else [({}, value)]
+
+
+class Metrics:
+    """Counters and timings of the app, exposed on /metrics."""
+
+    def __init__(self, app):
+        self.app = app
+
+        # configparser gives an empty string for "db_slow_query_time="
+        slow = app.cfg.get("rana", "db_slow_query_time", fallback="1")
+        self.slow_query_time = float(slow) if slow else None
+
+        self.query_seconds = Histogram(
+            "rana_db_query_seconds", "Time spent running queries.", ["query"]
+        )
+        self.query_rows = Counter(
+            "rana_db_query_rows_total",
+            "Rows returned or affected by queries.",
+            ["query"],
+        )
+        self.pool_wait_seconds = Histogram(
+            "rana_db_pool_wait_seconds",
+            "Time spent waiting for a pool connection.",
+            ["pool"],
+        )
+        self.request_seconds = Histogram(
+            "rana_request_seconds",
+            "Time spent answering requests.",
+            ["endpoint", "method", "status"],
+        )
+        self.heartbeats = Counter(
+            "rana_heartbeats_total",
+            "Processed heartbeats, inserted or rejected as duplicates.",
+            ["result"],
+        )
+
+        self.metrics: List[Metric] = [
+            self.query_seconds,
+            self.query_rows,
+            self.pool_wait_seconds,
+            self.request_seconds,
+            self.heartbeats,
+            Gauge(
+                "rana_db_pool_size",
+                "Open connections of each pool.",
+                ["pool"],
+                lambda: self._pools(lambda pool: pool.get_size()),
+            ),
+            Gauge(
+                "rana_db_pool_in_use",
+                "Connections of each pool running queries.",
+                ["pool"],
+                lambda: self._pools(
+                    lambda pool: pool.get_size() - pool.get_idle_size()
+                ),
+            ),
+            Gauge(
+                "rana_db_replica_lag_seconds",
+                "Seconds each replica is behind, as of its last check.",
+                ["replica"],
+                self._replica_lag,
+            ),
+            CounterView(
+                "rana_db_replica_reads_total",
+                "Reads served by replicas.",
+                [],
+                lambda: _one(self.app.db.replicas.reads),
+            ),
+            CounterView(
+                "rana_db_replica_fallbacks_total",
+                "Replica reads that went to the primary.",
+                [],
+                lambda: _one(self.app.db.replicas.fallbacks),
+            ),
+            Gauge(
+                "rana_ingest_queue_depth",
+                "Heartbeats waiting on the ingest queue.",
+                [],
+                lambda: _one(self._read("ingest", "depth")),
+            ),
+            CounterView(
+                "rana_ingest_flushes_total",
+                "Bulk inserts of the ingest queue.",
+                [],
+                lambda: _one(self._read("ingest", "flushes")),
+            ),
+            CounterView(
+                "rana_ingest_flush_errors_total",
+                "Bulk inserts of the ingest queue that failed.",
+                [],
+                lambda: _one(self._read("ingest", "flush_errors")),
+            ),
+            CounterView(
+                "rana_ingest_flushed_heartbeats_total",
+                "Heartbeats inserted by the ingest queue.",
+                [],
+                lambda: _one(self._read("ingest", "flushed_heartbeats")),
+            ),
+            CounterView(
+                "rana_ingest_retried_heartbeats_total",
+                "Heartbeats the ingest queue tried to insert again.",
+                [],
+                lambda: _one(self._read("ingest", "retried_heartbeats")),
+            ),
+            CounterView(
+                "rana_ingest_dropped_heartbeats_total",
+                "Heartbeats the ingest queue gave up on inserting.",
+                [],
+                lambda: _one(self._read("ingest", "dropped_heartbeats")),
+            ),
+            Gauge(
+                "rana_ingest_last_flush_seconds",
+                "Time the last bulk insert of the ingest queue took.",
+                [],
+                lambda: _one(self._read("ingest", "last_flush_latency")),
+            ),
+            CounterView(
+                "rana_ingest_flush_seconds_total",
+                "Time spent on bulk inserts of the ingest queue.",
+                [],
+                lambda: _one(self._read("ingest", "total_flush_latency")),
+            ),
+            CounterView(
+                "rana_password_jobs_total",
+                "Password hashes and checks that ran.",
+                [],
+                lambda: _one(self._read("password_pool", "jobs")),
+            ),
+            CounterView(
+                "rana_password_rejected_total",
+                "Password hashes and checks refused by a full pool.",
+                [],
+                lambda: _one(self._read("password_pool", "rejected")),
+            ),
+            CounterView(
+                "rana_password_wait_seconds_total",
+                "Time password jobs spent waiting for a worker.",
+                [],
+                lambda: _one(self._read("password_pool", "total_wait_time")),
+            ),
+            CounterView(
+                "rana_password_hash_seconds_total",
+                "Time workers spent hashing and checking passwords.",
+                [],
+                lambda: _one(self._read("password_pool", "total_hash_time")),
+            ),
+            CounterView(
+                "rana_janitor_removed_heartbeats_total",
+                "Heartbeats removed by the data janitor.",
+                [],
+                lambda: _one(self._read("janitor", "rows_removed")),
+            ),
+            CounterView(
+                "rana_janitor_dropped_partitions_total",
+                "Heartbeats partitions dropped by the data janitor.",
+                [],
+                lambda: _one(self._read("janitor", "partitions_dropped")),
+            ),
+            CounterView(
+                "rana_janitor_seconds_total",
+                "Time spent on data janitor cycles.",
+                [],
+                lambda: _one(self._read("janitor", "time_spent")),
+            ),
+        ]
+
+    def observe_query(self, query: str, elapsed: float, result):
+        """Record a query that took the given seconds to run."""
+        name = query_name(query)
+        self.query_seconds.observe(elapsed, query=name)
+        self.query_rows.inc(row_count(result), query=name)
+
+        if self.slow_query_time is not None and elapsed >= self.slow_query_time:
+            log.warning("slow query %r took %.3fs", name, elapsed)
+
+    def _pools(self, read) -> Samples:
+        db = self.app.db
+        if db.conn is not None:
+            yield {"pool": "primary"}, read(db.conn)
+
+        for idx, replica in enumerate(db.replicas.replicas):
+            if replica.pool is not None:
+                yield {"pool": f"replica{idx}"}, read(replica.pool)
+
+    def _replica_lag(self) -> Samples:
+        for idx, replica in enumerate(self.app.db.replicas.replicas):
+            if replica.lag is not None:
+                yield {"replica": str(idx)}, replica.lag
+
+    def _read(self, component: str, attr: str) -> Optional[float]:
+        """Read a counter of app.<component>, which may not be there."""
+        obj = getattr(self.app, component, None)
+        return None if obj is None else getattr(obj, attr)
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,454 @@
+import re
+import logging
+from typing import List, NamedTuple
+
+log = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    """A change to the schema.
+
+    Concurrent migrations run their statements one by one outside of
+    a transaction, as CREATE INDEX CONCURRENTLY requires. Everything
+    else runs in a single transaction.
+    """
+
+    version: int
+    description: str
+    statements: List[str]
+    concurrently: bool = False
+
+
+# the schema as it was before versioning. instances that predate this
+# runner already have it, hence the "if not exists" everywhere.
+BASELINE_SCRIPT = """
+create table if not exists users (
+    id uuid primary key,
+    username text unique not null,
+    password_hash text not null,
+    timezone text not null default 'Etc/GMT0',
+
+    display_name text default null,
+    website text default null,
+
+    created_at bigint not null,
+    modified_at bigint default null,
+
+    languages_used_public bool default false not null,
+    logged_time_public bool default false not null,
+
+    last_heartbeat_at bigint default null,
+    last_plugin text default null,
+    last_plugin_name text default null,
+    last_project text default null
+);
+
+create table if not exists api_keys (
+    user_id uuid primary key references users (id),
+    key text not null
+);
+
+create table if not exists machines (
+    id uuid primary key,
+    user_id uuid references users (id),
+    name text
+);
+
+create table if not exists heartbeats (
+    id uuid primary key,
+    user_id uuid references users (id),
+    machine_id uuid references machines (id),
+
+    entity text not null,
+    type text not null,
+    category text default null,
+    time real not null,
+    is_write bool not null default false,
+
+    project text default null,
+    branch text default null,
+    language text default null,
+    lines bigint not null,
+    lineno bigint default null,
+    cursorpos bigint default null
+);
+"""
+
+# machines with the same name were created by heartbeats racing each
+# other. the oldest-looking one of each name is kept.
+MACHINES_SCRIPT = """
+create temporary table machine_duplicates on commit drop as
+select id, first_value(id) over (partition by user_id, name order by id) as keep_id
+from machines
+where name is not null;
+
+update heartbeats
+set machine_id = dup.keep_id
+from machine_duplicates dup
+where heartbeats.machine_id = dup.id and dup.id <> dup.keep_id;
+
+delete from machines
+using machine_duplicates dup
+where machines.id = dup.id and dup.id <> dup.keep_id;
+
+create unique index machines_user_id_name_idx on machines (user_id, name);
+"""
+
+# strings repeated across heartbeats (entities, projects, languages...)
+# are stored once, and heartbeats refer to them by id.
+INTERNED_STRINGS_SCRIPT = """
+create table interned_strings (
+    id serial primary key,
+    value text not null
+);
+
+-- a btree on the values themselves rejects long ones, like URLs
+create unique index interned_strings_value_md5_idx
+    on interned_strings (md5(value));
+
+insert into interned_strings (value)
+select distinct value
+from heartbeats,
+    unnest(array[entity, type, category, project, branch, language]) as value
+where value is not null
+order by value;
+"""
+
+# heartbeats are partitioned by month, see Database.create_partitions.
+# rows outside of the created partitions land on heartbeats_default, so
+# the months that already have heartbeats get their partitions here.
+HEARTBEATS_SCRIPT = """
+alter table heartbeats rename to heartbeats_unpartitioned;
+alter index heartbeats_pkey rename to heartbeats_unpartitioned_pkey;
+
+create table heartbeats (
+    id uuid not null,
+    user_id uuid references users (id),
+    machine_id uuid references machines (id),
+
+    -- ids from interned_strings
+    entity_id integer not null,
+    type_id integer not null,
+    category_id integer default null,
+    time double precision not null,
+    is_write bool not null default false,
+
+    -- ids from interned_strings
+    project_id integer default null,
+    branch_id integer default null,
+    language_id integer default null,
+    lines bigint not null,
+    lineno bigint default null,
+    cursorpos bigint default null,
+
+    primary key (id, time)
+) partition by range (time);
+
+create table heartbeats_default
+    partition of heartbeats default;
+
+do $$
+declare
+    month timestamp;
+begin
+    for month in
+        select generate_series(first_month, last_month, interval '1 month')
+        from (
+            select
+                date_trunc('month', to_timestamp(min(time)) at time zone 'UTC')
+                    as first_month,
+                date_trunc('month', to_timestamp(max(time)) at time zone 'UTC')
+                    as last_month
+            from heartbeats_unpartitioned
+        ) as bounds
+    loop
+        -- the same names and bounds as rana.database.month_partition
+        execute format(
+            'create table %I partition of heartbeats for values from (%s) to (%s)',
+            to_char(month, '"heartbeats_y"YYYY"m"MM'),
+            extract(epoch from month),
+            extract(epoch from month + interval '1 month')
+        );
+    end loop;
+end
+$$;
+
+insert into heartbeats (id, user_id, machine_id, entity_id, type_id,
+    category_id, time, is_write, project_id, branch_id, language_id,
+    lines, lineno, cursorpos)
+select hb.id, hb.user_id, hb.machine_id, entity.id, type.id,
+    category.id, hb.time, hb.is_write, project.id, branch.id, language.id,
+    hb.lines, hb.lineno, hb.cursorpos
+from heartbeats_unpartitioned hb
+join interned_strings entity on entity.value = hb.entity
+join interned_strings type on type.value = hb.type
+left join interned_strings category on category.value = hb.category
+left join interned_strings project on project.value = hb.project
+left join interned_strings branch on branch.value = hb.branch
+left join interned_strings language on language.value = hb.language;
+
+drop table heartbeats_unpartitioned;
+"""
+
+# spans of merged write heartbeats, kept up to date as heartbeats
+# arrive. see rana.blueprints.durations.update_durations, which this
+# backfill does the same as.
+DURATIONS_SCRIPT = """
+create table durations (
+    id uuid primary key,
+    user_id uuid references users (id),
+
+    -- ids from interned_strings
+    project_id integer default null,
+    language_id integer default null,
+    branch_id integer default null,
+
+    started_at double precision not null,
+    ended_at double precision not null
+);
+
+with pairs as (
+    select *, lead(time) over (partition by user_id order by time) as next_time
+    from (
+        select distinct user_id, time, project_id, language_id, branch_id
+        from heartbeats
+        where is_write = true
+    ) as hb
+), duration_rows as (
+    -- a row starts a new duration if it changes project or is too far
+    -- from the previous row
+    select *,
+        coalesce(
+            lag(project_id) over w is distinct from project_id
+            or time - lag(next_time) over w >= 600,
+            true
+        ) as is_first
+    from pairs
+    where next_time - time < 600
+    window w as (partition by user_id order by time)
+), numbered as (
+    select *,
+        count(*) filter (where is_first) over (
+            partition by user_id order by time rows unbounded preceding
+        ) as duration
+    from duration_rows
+)
+insert into durations (id, user_id, project_id, language_id, branch_id,
+    started_at, ended_at)
+select gen_random_uuid(), user_id,
+    (array_agg(project_id order by time))[1],
+    (array_agg(language_id order by time))[1],
+    (array_agg(branch_id order by time))[1],
+    min(time), max(next_time)
+from numbered
+group by user_id, duration;
+"""
+
+# calculated on demand, so they start out empty
+SUMMARIES_SCRIPT = """
+-- per-day totals of each user's durations, on the user's local days.
+-- see rana.rollups.
+create table daily_rollups (
+    user_id uuid references users (id),
+    day date not null,
+
+    -- ids from interned_strings
+    project_id integer default null,
+    language_id integer default null,
+    branch_id integer default null,
+
+    total_seconds double precision not null
+);
+
+-- days that have their rollups calculated. new heartbeats mark
+-- their days as stale.
+create table rollup_days (
+    user_id uuid references users (id),
+    day date not null,
+
+    -- the timezone the day was calculated on
+    timezone text not null,
+    stale boolean not null default false,
+
+    primary key (user_id, day)
+);
+
+-- per-user, per-language seconds of each closed UTC day, for the
+-- leaderboards. see rana.leaderboards.LeaderboardWindow.
+create table leaderboard_buckets (
+    day date not null,
+    user_id uuid references users (id),
+    language_id integer default null,
+    total_seconds double precision not null
+);
+
+create table leaderboard_days (
+    day date primary key,
+    stale boolean not null default false,
+
+    -- bumped every time the day goes stale
+    generation bigint not null default 0
+);
+"""
+
+MIGRATIONS = [
+    Migration(1, "baseline", [BASELINE_SCRIPT]),
+    Migration(2, "unique machine names", [MACHINES_SCRIPT]),
+    Migration(3, "interned strings", [INTERNED_STRINGS_SCRIPT]),
+    Migration(4, "heartbeats by month, with interned strings", [HEARTBEATS_SCRIPT]),
+    Migration(5, "durations", [DURATIONS_SCRIPT]),
+    Migration(6, "rollups and leaderboards", [SUMMARIES_SCRIPT]),
+    # indexes on partitioned tables can't be built concurrently
+    Migration(
+        7,
+        "heartbeats indexes",
+        [
+            """
+        create index if not exists heartbeats_user_entity_time_idx
+            on heartbeats (user_id, entity_id, time)
+        """,
+            """
+        create index if not exists heartbeats_time_idx
+            on heartbeats (time)
+        """,
+            """
+        create index if not exists heartbeats_user_write_time_idx
+            on heartbeats (user_id, time) where is_write = true
+        """,
+        ],
+    ),
+    Migration(
+        8,
+        "hot path indexes",
+        [
+            """
+        create unique index concurrently if not exists api_keys_key_idx
+            on api_keys (key)
+        """,
+            """
+        create index concurrently if not exists durations_user_ended_idx
+            on durations (user_id, ended_at)
+        """,
+            # for the leaderboards, which look at everyone's last week
+            """
+        create index concurrently if not exists durations_ended_idx
+            on durations (ended_at)
+        """,
+            """
+        create index concurrently if not exists daily_rollups_user_day_idx
+            on daily_rollups (user_id, day)
+        """,
+            """
+        create index concurrently if not exists leaderboard_buckets_day_idx
+            on leaderboard_buckets (day)
+        """,
+            # for RollupJob, so it doesn't scan every calculated day
+            """
+        create index concurrently if not exists rollup_days_stale_idx
+            on rollup_days (user_id, day) where stale
+        """,
+        ],
+        concurrently=True,
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# any constant works, it only has to be the same for every process
+MIGRATION_LOCK_KEY = 0x72616E61
+
+
+async def schema_version(conn) -> int:
+    """Return the version of the schema, 0 if it isn't versioned yet."""
+    if await conn.fetchval("select to_regclass('schema_version')") is None:
+        return 0
+
+    version = await conn.fetchval("select max(version) from schema_version")
+    return version or 0
+
+
+# the indexes a concurrent migration builds
+INDEX_NAME_REGEX = re.compile(
+    r"create (?:unique )?index concurrently if not exists (\w+)"
+)
+
+
+async def _drop_invalid_indexes(conn, migration: Migration):
+    # a concurrent build that fails halfway leaves an invalid index
+    # behind, and "if not exists" would happily keep it
+    names = [
+        match.group(1)
+        for statement in migration.statements
+        for match in INDEX_NAME_REGEX.finditer(statement)
+    ]
+
+    rows = await conn.fetch(
+        """
+    select index.relname
+    from pg_index
+    join pg_class index on index.oid = pg_index.indexrelid
+    where not pg_index.indisvalid
+      and index.relname = any($1::text[])
+      and pg_table_is_visible(index.oid)
+    """,
+        names,
+    )
+
+    for (name,) in rows:
+        log.warning("dropping invalid index %r", name)
+        await conn.execute(f"drop index concurrently if exists {name}")
+
+
+async def _apply(conn, migration: Migration):
+    log.info("applying migration %d: %s", migration.version, migration.description)
+
+    if migration.concurrently:
+        await _drop_invalid_indexes(conn, migration)
+        for statement in migration.statements:
+            await conn.execute(statement)
+
+        await conn.execute(
+            "insert into schema_version (version) values ($1)", migration.version
+        )
+        return
+
+    async with conn.transaction():
+        for statement in migration.statements:
+            await conn.execute(statement)
+
+        await conn.execute(
+            "insert into schema_version (version) values ($1)", migration.version
+        )
+
+
+async def migrate(conn) -> int:
+    """Bring the schema up to date. Returns how many migrations
+    were applied.
+
+    The connection must not be in a transaction. When the schema
+    is already up to date, this runs no DDL at all.
+    """
+    if await schema_version(conn) >= LATEST_VERSION:
+        return 0
+
+    # other processes starting at the same time wait for us
+    await conn.execute("select pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+    try:
+        await conn.execute(
+            """
+        create table if not exists schema_version (
+            version integer primary key,
+            applied_at timestamptz not null default now()
+        )
+        """
+        )
+
+        current = await schema_version(conn)
+        pending = [mig for mig in MIGRATIONS if mig.version > current]
+
+        for migration in pending:
+            await _apply(conn, migration)
+
+        return len(pending)
+    finally:
+        await conn.execute("select pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
@@ -1,6 +1,7 @@
 import logging
 import re
-from typing import Union, Dict, List, Optional
+from collections.abc import Mapping, Sequence
+from typing import Union, Dict, List, Optional, Tuple, Callable, Any
 
 from cerberus import Validator
 from quart import current_app as app
@@ -42,6 +43,276 @@ class RanaValidator(Validator):
         )
 
 
+class SchemaNotCompilable(Exception):
+    """The schema uses something the compiled validator doesn't do,
+    so it's left to cerberus."""
+
+
+# rules the compiled validator knows how to apply. schemas using
+# anything else are validated by cerberus.
+_COMPILABLE_RULES = {
+    "type",
+    "required",
+    "nullable",
+    "default",
+    "coerce",
+    "dependencies",
+    "schema",
+}
+
+_BUILTIN_TYPES = {
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int),
+    "boolean": lambda value: isinstance(value, bool),
+    "dict": lambda value: isinstance(value, Mapping),
+    "list": lambda value: isinstance(value, Sequence) and not isinstance(value, str),
+}
+
+
+# custom types are checked by the methods of a validator of our own
+_TYPES_VALIDATOR = RanaValidator()
+
+
+def _type_checker(type_name: str) -> Callable[[Any], bool]:
+    try:
+        return _BUILTIN_TYPES[type_name]
+    except KeyError:
+        pass
+
+    method = getattr(_TYPES_VALIDATOR, f"_validate_type_{type_name}", None)
+    if method is None:
+        raise SchemaNotCompilable(f"unknown type {type_name!r}")
+
+    return method
+
+
+class _Field:
+    """Rules of a single field, as used by CompiledSchema."""
+
+    __slots__ = (
+        "name",
+        "type_name",
+        "check_type",
+        "required",
+        "nullable",
+        "has_default",
+        "default",
+        "coerce",
+        "dependencies",
+        "items",
+    )
+
+    def __init__(self, name: str, rules: Dict):
+        unknown_rules = set(rules) - _COMPILABLE_RULES
+        if unknown_rules:
+            raise SchemaNotCompilable(f"can't compile rules {unknown_rules!r}")
+
+        self.name = name
+        self.type_name = rules.get("type")
+        self.check_type = _type_checker(self.type_name) if self.type_name else None
+        self.required = rules.get("required", False)
+        self.nullable = rules.get("nullable", False)
+        self.has_default = "default" in rules
+        self.default = rules.get("default")
+        self.coerce = rules.get("coerce")
+
+        if self.coerce is not None and not callable(self.coerce):
+            raise SchemaNotCompilable("only callable coercers are compiled")
+
+        dependencies = rules.get("dependencies", ())
+        if isinstance(dependencies, str):
+            dependencies = (dependencies,)
+        if not isinstance(dependencies, (list, tuple)):
+            raise SchemaNotCompilable("only sequence dependencies are compiled")
+        self.dependencies = tuple(dependencies)
+
+        # list fields carry the rules of their items, dict fields carry
+        # a CompiledSchema of their own
+        self.items: Optional[Union["_Field", "CompiledSchema"]] = None
+        if "schema" in rules:
+            if self.type_name == "list":
+                self.items = _Field(name, rules["schema"])
+            elif self.type_name == "dict":
+                self.items = CompiledSchema(rules["schema"])
+            else:
+                raise SchemaNotCompilable("schema rule without list or dict type")
+
+    def normalize(self, value) -> Tuple[Any, List]:
+        """Normalize a present value, giving the value and
+        the errors found while doing so."""
+        errors: List = []
+
+        if self.coerce is not None:
+            try:
+                value = self.coerce(value)
+            except Exception as err:
+                if not (self.nullable and value is None):
+                    errors.append(f"field '{self.name}' cannot be coerced: {err}")
+
+        if self.items is None or value is None:
+            return value, errors
+
+        if self.type_name == "list" and _BUILTIN_TYPES["list"](value):
+            normalized, item_errors = [], {}
+
+            for idx, item in enumerate(value):
+                item, errs = self.items.normalize(item)
+                normalized.append(item)
+                if errs:
+                    item_errors[idx] = errs
+
+            value = normalized
+            if item_errors:
+                errors.append(item_errors)
+        elif self.type_name == "dict" and isinstance(value, Mapping):
+            value, errs = self.items.normalize(value)
+            if errs:
+                errors.append(errs)
+
+        return value, errors
+
+    def check(self, value, document) -> List:
+        """Validate a normalized value, giving a list of errors."""
+        if value is None:
+            return [] if self.nullable else ["null value not allowed"]
+
+        if self.check_type is not None and not self.check_type(value):
+            return [f"must be of {self.type_name} type"]
+
+        errors: List = [
+            f"field '{dep}' is required"
+            for dep in self.dependencies
+            if dep not in document
+        ]
+
+        if errors or self.items is None:
+            return errors
+
+        if self.type_name == "list":
+            item_errors = {}
+            for idx, item in enumerate(value):
+                errs = self.items.check(item, {})
+                if errs:
+                    item_errors[idx] = errs
+
+            if item_errors:
+                errors.append(item_errors)
+        else:
+            errs = self.items.check(value)
+            if errs:
+                errors.append(errs)
+
+        return errors
+
+
+class CompiledSchema:
+    """A cerberus schema turned into plain python checks.
+
+    Gives the same documents as RanaValidator for the subset of rules
+    used by Rana's schemas, without building a validator (and resolving
+    the schema's rules) on every call.
+    """
+
+    def __init__(self, schema: Dict):
+        self.fields = {name: _Field(name, rules) for name, rules in schema.items()}
+        self.required = [field.name for field in self.fields.values() if field.required]
+        self.defaults = [field for field in self.fields.values() if field.has_default]
+        self.normalized = [
+            field
+            for field in self.fields.values()
+            if field.coerce is not None or field.items is not None
+        ]
+
+    def normalize(self, document: Mapping) -> Tuple[Dict, Dict]:
+        """Apply defaults and coercions, giving the normalized document
+        and the errors found while doing so."""
+        document = dict(document)
+        errors: Dict = {}
+
+        for field in self.defaults:
+            name = field.name
+            if name not in document or (
+                document[name] is None and not field.nullable
+            ):
+                document[name] = field.default
+
+        for field in self.normalized:
+            name = field.name
+            if name in document:
+                document[name], errs = field.normalize(document[name])
+                if errs:
+                    errors[name] = errs
+
+        return document, errors
+
+    def check(self, document: Mapping) -> Dict:
+        """Validate an already normalized document, giving the errors."""
+        errors: Dict = {}
+
+        for name, value in document.items():
+            field = self.fields.get(name)
+            if field is None:
+                errors[name] = ["unknown field"]
+                continue
+
+            errs = field.check(value, document)
+            if errs:
+                errors[name] = errs
+
+        for name in self.required:
+            if name not in document:
+                errors[name] = ["required field"]
+
+        return errors
+
+    def validate(self, document) -> Tuple[Optional[Dict], Dict]:
+        """Normalize and validate a document, giving the normalized
+        document and the validation errors."""
+        if not isinstance(document, Mapping):
+            return None, {"document": [f"{document!r} is not a document"]}
+
+        document, errors = self.normalize(document)
+
+        for name, errs in self.check(document).items():
+            _merge_errors(errors.setdefault(name, []), errs)
+
+        return document, errors
+
+
+def _merge_errors(errors: List, new_errors: List):
+    """Merge a field's list of errors into another, joining the
+    errors of subdocuments like cerberus does."""
+    for error in new_errors:
+        if isinstance(error, dict) and errors and isinstance(errors[-1], dict):
+            for key, errs in error.items():
+                _merge_errors(errors[-1].setdefault(key, []), errs)
+        else:
+            errors.append(error)
+
+
+# id of schema -> (schema, compiled schema or None when the schema
+# can't be compiled). the schema is kept to keep its id valid.
+_COMPILED: Dict[int, Tuple[Dict, Optional[CompiledSchema]]] = {}
+
+
+def compiled_schema(schema: Dict) -> Optional[CompiledSchema]:
+    """Return the cached compiled version of the given schema, or None
+    if the schema uses rules that can't be compiled."""
+    try:
+        return _COMPILED[id(schema)][1]
+    except KeyError:
+        pass
+
+    try:
+        compiled: Optional[CompiledSchema] = CompiledSchema(schema)
+    except SchemaNotCompilable as err:
+        log.debug("not compiling schema: %s", err)
+        compiled = None
+
+    _COMPILED[id(schema)] = (schema, compiled)
+    return compiled
+
+
 def validate(
     reqjson: Union[Dict, List], schema: Dict, raise_err: bool = True
 ) -> Optional[Dict]:
@@ -58,6 +329,25 @@ def validate(
         If we should raise a BadRequest error when the validation
         fails. Default is true.
     """
+    compiled = compiled_schema(schema)
+
+    if compiled is not None:
+        document, errs = compiled.validate(reqjson)
+    else:
+        document, errs = _cerberus_validate(reqjson, schema)
+
+    if errs:
+        log.warning("Error validating doc %r: %r", reqjson, errs)
+
+        if raise_err:
+            raise BadRequest(f"bad payload: {errs!r}")
+
+        return None
+
+    return document
+
+
+def _cerberus_validate(reqjson, schema: Dict) -> Tuple[Optional[Dict], Dict]:
     validator = RanaValidator(schema)
 
     try:
@@ -67,15 +357,9 @@ def validate(
         raise Exception(f"Error while validating: {reqjson}")
 
     if not valid:
-        errs = validator.errors
-        log.warning("Error validating doc %r: %r", reqjson, errs)
-
-        if raise_err:
-            raise BadRequest(f"bad payload: {errs!r}")
-
-        return None
+        return None, validator.errors
 
-    return validator.document
+    return validator.document, {}
 
 
 HEARTBEAT_MODEL = {
@@ -134,3 +418,7 @@ LEADERS_IN = {
     "language": {"type": "string", "required": False},
     "page": {"coerce": int, "required": False, "default": 0},
 }
+
+HEARTBEATS_BULK_IN = {
+    "hbs": {"type": "list", "schema": {"type": "dict", "schema": HEARTBEAT_MODEL}}
+}
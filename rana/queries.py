@@ -0,0 +1,62 @@
+"""Named hot queries.
+
+Each connection of the pool prepares these once, when it is set up, so
+that running them skips parsing and planning. Run them through the
+*_named methods of Database and RanaConnection.
+"""
+
+# a single lookup for the close heartbeats of a batch, done as a range
+# scan on heartbeats_user_entity_time_idx.
+HEARTBEATS_DEDUP = """
+select hb.idx, h.id, h.entity_id, h.type_id, h.time, h.project_id
+from unnest($2::int[], $3::int[], $4::float8[]) as hb(idx, entity_id, time)
+join lateral (
+    select heartbeats.id, heartbeats.entity_id, heartbeats.type_id,
+           heartbeats.time, heartbeats.project_id
+    from heartbeats
+    where heartbeats.user_id = $1
+      and heartbeats.entity_id = hb.entity_id
+      and heartbeats.time > hb.time - 60
+      and heartbeats.time < hb.time + 60
+    limit 1
+) as h on true
+"""
+
+HEARTBEATS_INSERT = """
+insert into heartbeats (id, user_id, machine_id,
+    entity_id, type_id, category_id, time,
+    is_write, project_id, branch_id, language_id,
+    lines, lineno, cursorpos)
+select
+    hb.id, $1, $2,
+    hb.entity_id, hb.type_id, hb.category_id, hb.time,
+    hb.is_write, hb.project_id, hb.branch_id, hb.language_id,
+    hb.lines, hb.lineno, hb.cursorpos
+from unnest(
+    $3::uuid[], $4::int[], $5::int[], $6::int[], $7::float8[],
+    $8::bool[], $9::int[], $10::int[], $11::int[],
+    $12::bigint[], $13::bigint[], $14::bigint[]
+) as hb(id, entity_id, type_id, category_id, time,
+        is_write, project_id, branch_id, language_id,
+        lines, lineno, cursorpos)
+returning id, entity_id, type_id, time, project_id
+"""
+
+API_KEY_USER = """
+select user_id from api_keys where key = $1
+"""
+
+DURATIONS_RANGE = """
+select user_id, language_id, project_id,
+       greatest(started_at, $2), least(ended_at, $3), branch_id
+from durations
+where user_id = $1 and ended_at > $2 and started_at < $3
+order by started_at
+"""
+
+QUERIES = {
+    "heartbeats_dedup": HEARTBEATS_DEDUP,
+    "heartbeats_insert": HEARTBEATS_INSERT,
+    "api_key_user": API_KEY_USER,
+    "durations_range": DURATIONS_RANGE,
+}
@@ -0,0 +1,151 @@
+import asyncio
+import itertools
+import logging
+from typing import List, Optional
+
+import asyncpg
+
+log = logging.getLogger(__name__)
+
+# seconds a replica is behind the primary. a replica that replayed
+# everything it received is caught up, even when the primary hasn't
+# written anything in a while.
+LAG_QUERY = """
+select case
+    when not pg_is_in_recovery() then 0
+    when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+    else coalesce(
+        extract(epoch from now() - pg_last_xact_replay_timestamp())::float8,
+        'infinity'
+    )
+end
+"""
+
+# errors that mean the replica can't serve reads right now. queries
+# cancelled by a conflict with recovery fail with a serialization error.
+REPLICA_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.SerializationError,
+)
+
+
+class Replica:
+    """A read replica and its connection pool."""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+
+        # None until the replica is known to be reachable
+        self.lag: Optional[float] = None
+
+
+class ReplicaSet:
+    """The read replicas in db_replicas, checked for replication lag
+    every db_replica_check_interval seconds.
+
+    Reads are spread across the replicas that are reachable and at most
+    db_replica_max_lag seconds behind the primary.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.replicas: List[Replica] = [
+            Replica(dsn)
+            for dsn in app.cfg.get("rana", "db_replicas", fallback="").split()
+        ]
+        self.max_lag = app.cfg.getfloat("rana", "db_replica_max_lag", fallback=10)
+        self.interval = app.cfg.getfloat(
+            "rana", "db_replica_check_interval", fallback=5
+        )
+
+        self._pool_options: dict = {}
+        self._next = itertools.count()
+        self._task = None
+
+        # counters
+        self.checks = 0
+        self.reads = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    async def connect(self, **pool_options):
+        """Create the pools of the replicas, with the given options for
+        asyncpg.create_pool, and check their lag."""
+        self._pool_options = pool_options
+        await self.check()
+
+    def start(self):
+        """Start the background job."""
+        if not self.enabled:
+            return
+
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop the background job and close the pools."""
+        if self._task is not None:
+            self._task.cancel()
+
+        for replica in self.replicas:
+            if replica.pool is not None:
+                await replica.pool.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.check()
+            except Exception:
+                log.exception("replica check failed")
+
+    async def _check_replica(self, replica: Replica):
+        if replica.pool is None:
+            replica.pool = await asyncpg.create_pool(
+                dsn=replica.dsn, **self._pool_options
+            )
+
+        replica.lag = await replica.pool.fetchval(LAG_QUERY, timeout=self.interval)
+
+    async def check(self):
+        """Update the lag of every replica, connecting to the ones
+        that don't have a pool yet."""
+        for idx, replica in enumerate(self.replicas):
+            try:
+                await self._check_replica(replica)
+            except REPLICA_ERRORS as err:
+                # the dsn may hold a password, so only the index is logged
+                log.warning("replica %d is unreachable: %r", idx, err)
+                replica.lag = None
+
+        self.checks += 1
+
+    def pick(self):
+        """Return the pool of a replica to read from, or None if the
+        read should go to the primary."""
+        usable = [
+            replica
+            for replica in self.replicas
+            if replica.lag is not None and replica.lag <= self.max_lag
+        ]
+
+        if not usable:
+            if self.enabled:
+                self.fallbacks += 1
+            return None
+
+        return usable[next(self._next) % len(usable)].pool
+
+    def mark_failed(self, pool):
+        """Stop using the replica with the given pool until its next
+        successful check."""
+        for replica in self.replicas:
+            if replica.pool is pool:
+                replica.lag = None
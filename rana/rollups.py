@@ -0,0 +1,305 @@
+import time
+import asyncio
+import logging
+import datetime
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+from rana.errors import NotFound
+from rana.context import user_context
+from rana.blueprints.durations import fetch_duration_rows
+
+log = logging.getLogger(__name__)
+
+ONE_DAY = datetime.timedelta(days=1)
+
+# seconds to leave users alone after their days failed to refresh,
+# so they don't take up every batch
+FAILED_USER_PAUSE = 3600
+
+
+def day_spans(tz, day: datetime.date) -> Tuple[float, float]:
+    """Return the POSIX timestamps of the start and end of the given
+    day, on the given pytz timezone."""
+    following = day + ONE_DAY
+    start = tz.localize(datetime.datetime(day.year, day.month, day.day))
+    end = tz.localize(datetime.datetime(following.year, following.month, following.day))
+    return start.timestamp(), end.timestamp()
+
+
+def cut_durations(durations: List[Dict[str, Any]], first: int, spans) -> tuple:
+    """Cut the durations that overlap the given day spans.
+
+    Starts looking at the first index, and returns it moved past the
+    durations that ended before the day, for the next day to use.
+    """
+    day_start, day_end = spans
+
+    # durations never overlap, so the ones that ended before this
+    # day also ended before any of the following days
+    while first < len(durations) and durations[first]["end"] <= day_start:
+        first += 1
+
+    day_durations = []
+    for duration in durations[first:]:
+        if duration["start"] >= day_end:
+            break
+
+        day_durations.append(
+            {
+                **duration,
+                "start": max(duration["start"], day_start),
+                "end": min(duration["end"], day_end),
+            }
+        )
+
+    return day_durations, first
+
+
+async def mark_stale(conn, user_id, start: float, end: float):
+    """Mark the rollups of the days around the given span (in UTC) as
+    stale, so that they are calculated again the next time they are
+    needed."""
+    # a local day is never more than a day away from the UTC one
+    first = datetime.datetime.utcfromtimestamp(start).date() - ONE_DAY
+    last = datetime.datetime.utcfromtimestamp(end).date() + ONE_DAY
+
+    await conn.execute(
+        """
+    update rollup_days
+    set stale = true
+    where user_id = $1 and day >= $2 and day <= $3 and not stale
+    """,
+        user_id,
+        first,
+        last,
+    )
+
+
+async def refresh_rollups(db, user_id, tz, days: List[datetime.date]):
+    """Calculate the rollups of the given days out of the user's
+    durations."""
+    days = sorted(days)
+    spans = [day_spans(tz, day) for day in days]
+
+    async with db.transaction() as conn:
+        # same lock as update_durations, so that durations can't change
+        # between reading them and marking the days as fresh
+        await conn.execute(
+            """
+        select pg_advisory_xact_lock(hashtext($1))
+        """,
+            str(user_id),
+        )
+
+        durations = await fetch_duration_rows(
+            conn, user_id, (spans[0][0], spans[-1][1])
+        )
+
+        rollups = []
+        first = 0
+        for day, spans_ in zip(days, spans):
+            day_durations, first = cut_durations(durations, first, spans_)
+
+            totals: Counter = Counter()
+            for duration in day_durations:
+                key = (duration["project"], duration["language"], duration["branch"])
+                totals[key] += duration["end"] - duration["start"]
+
+            rollups.extend((day, *key, seconds) for key, seconds in totals.items())
+
+        await conn.execute(
+            """
+        delete from daily_rollups where user_id = $1 and day = any($2::date[])
+        """,
+            user_id,
+            days,
+        )
+
+        await conn.execute(
+            """
+        insert into daily_rollups (user_id, day, project_id, language_id,
+            branch_id, total_seconds)
+        select $1, r.day, r.project_id, r.language_id, r.branch_id,
+               r.total_seconds
+        from unnest($2::date[], $3::int[], $4::int[], $5::int[], $6::float8[])
+            as r(day, project_id, language_id, branch_id, total_seconds)
+        """,
+            user_id,
+            [rollup[0] for rollup in rollups],
+            [rollup[1] for rollup in rollups],
+            [rollup[2] for rollup in rollups],
+            [rollup[3] for rollup in rollups],
+            [rollup[4] for rollup in rollups],
+        )
+
+        await conn.execute(
+            """
+        insert into rollup_days (user_id, day, timezone, stale)
+        select $1, d.day, $3, false
+        from unnest($2::date[]) as d(day)
+        on conflict (user_id, day) do update
+            set timezone = excluded.timezone, stale = false
+        """,
+            user_id,
+            days,
+            tz.zone,
+        )
+
+
+async def fetch_rollups(
+    db, user_id, tz, days: List[datetime.date]
+) -> Dict[datetime.date, List[Dict[str, Any]]]:
+    """Fetch the rollups of the given days, calculating the ones that
+    are missing or stale first.
+
+    Returns the rollups of each day, with strings instead of ids.
+
+    Unless days have to be calculated, this reads from a replica, so
+    heartbeats from the last few seconds can be missing.
+    """
+    fresh_rows = await db.fetch(
+        """
+    select day from rollup_days
+    where user_id = $1 and day >= $2 and day <= $3
+      and not stale and timezone = $4
+    """,
+        user_id,
+        min(days),
+        max(days),
+        tz.zone,
+        replica=True,
+    )
+
+    fresh = {row[0] for row in fresh_rows}
+    missing = [day for day in days if day not in fresh]
+
+    if missing:
+        log.debug("calculating %d rollups for uid %r", len(missing), user_id)
+        await refresh_rollups(db, user_id, tz, missing)
+
+    # the replica may not have the rollups we just calculated
+    rows = await db.fetch(
+        """
+    select day, project_id, language_id, branch_id, total_seconds
+    from daily_rollups
+    where user_id = $1 and day >= $2 and day <= $3
+    """,
+        user_id,
+        min(days),
+        max(days),
+        replica=not missing,
+    )
+
+    rollups = [
+        {
+            "day": row[0],
+            "project": row[1],
+            "language": row[2],
+            "branch": row[3],
+            "total_seconds": row[4],
+        }
+        for row in rows
+    ]
+    await db.resolve_keys(rollups, "project", "language", "branch")
+
+    by_day: Dict[datetime.date, List[Dict[str, Any]]] = defaultdict(list)
+    for rollup in rollups:
+        by_day[rollup["day"]].append(rollup)
+
+    return by_day
+
+
+class RollupJob:
+    """Background job that calculates stale daily rollups again, so
+    that summaries rarely have to do it themselves."""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.cfg.getfloat("rana", "rollup_interval", fallback=300)
+        self.batch_size = app.cfg.getint("rana", "rollup_batch", fallback=1000)
+
+        self._task = None
+
+        # user id -> when their days last failed to refresh
+        self._failed: Dict[Any, float] = {}
+
+        # counters
+        self.cycles = 0
+        self.days_refreshed = 0
+        self.failures = 0
+
+    def start(self):
+        """Start the background job."""
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Stop the background job."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        await self.app.db.ready.wait()
+
+        while True:
+            try:
+                await self.run_cycle()
+            except Exception:
+                log.exception("rollup job cycle failed")
+
+            await asyncio.sleep(self.interval)
+
+    async def run_cycle(self) -> int:
+        """Refresh a batch of stale days. Returns how many were
+        refreshed."""
+        db = self.app.db
+
+        now = time.monotonic()
+        self._failed = {
+            user_id: failed_at
+            for user_id, failed_at in self._failed.items()
+            if now - failed_at < FAILED_USER_PAUSE
+        }
+
+        rows = await db.fetch(
+            """
+        select user_id, day from rollup_days
+        where stale and not (user_id = any($2::uuid[]))
+        order by user_id, day
+        limit $1
+        """,
+            self.batch_size,
+            list(self._failed),
+        )
+
+        days_by_user: Dict[Any, List[datetime.date]] = defaultdict(list)
+        for user_id, day in rows:
+            days_by_user[user_id].append(day)
+
+        refreshed = 0
+        for user_id, days in days_by_user.items():
+            try:
+                ctx = await user_context(user_id, app_=self.app)
+                await refresh_rollups(db, user_id, ctx.tz, days)
+            except NotFound:
+                # deleted users don't need their days anymore
+                await db.execute(
+                    """
+                delete from rollup_days where user_id = $1
+                """,
+                    user_id,
+                )
+            except Exception:
+                log.exception("rollup job: failed to refresh uid %r", user_id)
+                self.failures += 1
+                self._failed[user_id] = time.monotonic()
+            else:
+                refreshed += len(days)
+
+        self.cycles += 1
+        self.days_refreshed += refreshed
+
+        if refreshed:
+            log.info("rollup job: refreshed %d days", refreshed)
+
+        return refreshed
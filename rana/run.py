@@ -1,10 +1,11 @@
+import time
 import logging
 import secrets
 from pathlib import Path
 
 from configparser import ConfigParser
 
-from quart import Quart, jsonify
+from quart import Quart, jsonify, request, g
 
 from rana.blueprints import (
     auth,
@@ -14,9 +15,18 @@ from rana.blueprints import (
     durations,
     summaries,
     leaders,
+    metrics,
 )
 from rana.errors import RanaError
+from rana.auth import setup_password_pool
 from rana.database import Database
+from rana.ingest import IngestQueue
+from rana.janitor import DataJanitor
+from rana.rollups import RollupJob
+from rana.leaderboards import LeaderboardRefresher
+from rana.metrics import Metrics
+from rana.compression import Compression
+from rana.utils import JSONEncoder
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +36,10 @@ def make_app() -> Quart:
     app_ = Quart(__name__, template_folder="./templates")
     app_._testing = False
 
+    # most responses go through rana.utils.json_dumps, this keeps
+    # quart's jsonify giving the same output for everything else
+    app_.json_encoder = JSONEncoder
+
     app_.cfg = ConfigParser()
     app_.cfg.read("config.ini")
 
@@ -43,6 +57,7 @@ def setup_blueprints(app_):
         durations: "/users",
         summaries: "/users",
         leaders: "/leaders",
+        metrics: -1,
     }
 
     for bpr, suffix in bps.items():
@@ -74,22 +89,75 @@ setup_blueprints(app)
 
 @app.before_serving
 async def app_before_serving():
+    app.metrics = Metrics(app)
+    app.compression = Compression(app)
+
     log.info("starting db")
     app.db = Database(app)
+    app.password_pool = setup_password_pool(app.cfg)
+
+    app.ingest = None
+    if app.cfg.get("rana", "ingest_mode", fallback="direct") == "queue":
+        log.info("starting ingest queue")
+        app.ingest = IngestQueue(app)
+        app.ingest.start()
+
+    app.janitor = DataJanitor(app)
+    app.janitor.start()
+
+    app.rollups = RollupJob(app)
+    app.rollups.start()
+
+    app.leaderboards = LeaderboardRefresher(app)
+    app.leaderboards.start()
 
 
 @app.after_serving
 async def app_after_serving():
+    await app.janitor.close()
+    await app.rollups.close()
+    await app.leaderboards.close()
+    app.password_pool.close()
+
+    if app.ingest is not None:
+        log.info("flushing ingest queue")
+        await app.ingest.close()
+
     log.info("closing db")
     await app.db.close()
 
 
+@app.before_request
+async def app_before_request():
+    g.request_started = time.monotonic()
+
+
+@app.after_request
+async def app_after_request(response):
+    response = await app.compression.compress_response(response)
+
+    started = g.get("request_started")
+    if started is not None:
+        app.metrics.request_seconds.observe(
+            time.monotonic() - started,
+            endpoint=request.endpoint or "none",
+            method=request.method,
+            status=str(response.status_code),
+        )
+
+    return response
+
+
 @app.errorhandler(RanaError)
 async def rana_error_handler(exception: RanaError):
     """Exception handler to convert RanaError exceptions into the proper
     JSON body + status code."""
     log.warning(f"err: {exception!r}")
-    return jsonify({"error": exception.message}), exception.status_code
+    return (
+        jsonify({"error": exception.message}),
+        exception.status_code,
+        exception.headers,
+    )
 
 
 @app.errorhandler(500)
@@ -0,0 +1,47 @@
+import datetime
+import functools
+from bisect import bisect_right
+from typing import Optional
+
+import pytz
+
+
+class TimezoneTable:
+    """The UTC offset transitions of a pytz timezone, for converting
+    many timestamps into it without going through pytz every time."""
+
+    def __init__(self, tz):
+        self.tz = tz
+
+        # static timezones (like UTC) have a single offset
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if transitions is None:
+            self.transitions = [datetime.datetime.min]
+            self.offsets = [(tz.utcoffset(None), tz)]
+            return
+
+        self.transitions = list(transitions)
+        self.offsets = [(info[0], tz._tzinfos[info]) for info in tz._transition_info]
+
+    def fromtimestamp(self, posix_tstamp: float) -> datetime.datetime:
+        """Convert a POSIX timestamp into an aware datetime on
+        the timezone.
+
+        Gives the same result as astimezone() on the pytz timezone.
+        """
+        utc_dt = datetime.datetime.utcfromtimestamp(posix_tstamp)
+        idx = max(0, bisect_right(self.transitions, utc_dt) - 1)
+        offset, tzinfo = self.offsets[idx]
+        return (utc_dt + offset).replace(tzinfo=tzinfo)
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(olson_tz: Optional[str]):
+    """Return the pytz timezone with the given name, UTC if empty."""
+    return pytz.timezone(olson_tz or "UTC")
+
+
+@functools.lru_cache(maxsize=None)
+def timezone_table(tz) -> TimezoneTable:
+    """Return the transition table of the given pytz timezone."""
+    return TimezoneTable(tz)
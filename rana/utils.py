@@ -1,6 +1,16 @@
+import json
+import time
+import uuid
 import datetime
+from collections import OrderedDict
 from typing import Any, Dict, Tuple, Sequence, Optional
-from quart import jsonify as quart_jsonify
+from quart import current_app as app
+from quart.json import JSONEncoder as QuartJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class Date:
@@ -46,11 +56,121 @@ class Date:
         return self.date, self.end_dt
 
 
-def jsonify(data: Any, *, extra=None) -> Dict[str, Any]:
+class LRUCache:
+    """A mapping with a maximum size. When full, the least recently
+    used key is evicted to make room for new ones."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Return the value for the given key, marking it as
+        recently used."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """Set a value, evicting the least recently used key
+        if the cache is full."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a key from the cache, returning its value."""
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove all keys from the cache."""
+        self._data.clear()
+
+
+class TTLCache(LRUCache):
+    """An LRUCache whose keys also expire after the given amount
+    of seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        item = super().get(key)
+        if item is None:
+            return default
+
+        value, expires_at = item
+        if time.monotonic() >= expires_at:
+            super().pop(key)
+            return default
+
+        return value
+
+    def set(self, key, value):
+        super().set(key, (value, time.monotonic() + self.ttl))
+
+    def pop(self, key, default=None):
+        item = super().pop(key)
+        return default if item is None else item[0]
+
+
+class JSONEncoder(QuartJSONEncoder):
+    """Encoder for the responses that don't go through json_dumps.
+
+    Gives the same output json_dumps does for dates and UUIDs.
+    """
+
+    def default(self, object_: Any) -> Any:
+        if isinstance(object_, (datetime.date, datetime.time)):
+            return object_.isoformat()
+        if isinstance(object_, uuid.UUID):
+            return str(object_)
+        return super().default(object_)
+
+
+def _orjson_default(object_: Any) -> Any:
+    # orjson only takes uuid.UUID itself, not the subclass asyncpg gives
+    if isinstance(object_, uuid.UUID):
+        return str(object_)
+    raise TypeError(f"{type(object_)!r} is not JSON serializable")
+
+
+def json_dumps(data: Any) -> bytes:
+    """Encode the given data as JSON, with orjson if it's installed.
+
+    Datetimes, dates and UUIDs are encoded as their ISO and hex strings.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_orjson_default)
+
+    return json.dumps(
+        data, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def json_response(data: Any):
+    """Return a response with the given data as its JSON body."""
+    return app.response_class(json_dumps(data), content_type="application/json")
+
+
+def jsonify(data: Any, *, extra=None):
     """Wrap given data in a json object containing a key named data.
 
     This is necessary to comply with the Wakatime API request/reponse format.
     """
     extra = extra or {}
     extra["data"] = data
-    return quart_jsonify(extra)
+    return json_response(extra)
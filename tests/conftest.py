@@ -91,6 +91,34 @@ async def test_user(app, event_loop):
         user_id,
     )
 
+    await app.db.execute(
+        """
+    delete from durations where user_id = $1
+    """,
+        user_id,
+    )
+
+    await app.db.execute(
+        """
+    delete from daily_rollups where user_id = $1
+    """,
+        user_id,
+    )
+
+    await app.db.execute(
+        """
+    delete from rollup_days where user_id = $1
+    """,
+        user_id,
+    )
+
+    await app.db.execute(
+        """
+    delete from leaderboard_buckets where user_id = $1
+    """,
+        user_id,
+    )
+
     await app.db.execute(
         """
     delete from machines where user_id = $1
@@ -104,6 +132,7 @@ async def test_user(app, event_loop):
     """,
         user_id,
     )
+    app.db.invalidate_user(user_id)
 
 
 @pytest.fixture
@@ -29,3 +29,22 @@ class RanaTestClient:
         """Send a POST request."""
         kwargs["headers"] = self._inject_auth(kwargs)
         return await self.cli.post(*args, **kwargs)
+
+
+def make_heartbeat(hb_time: float, **fields) -> dict:
+    """Return a write heartbeat as it comes out of validation, with the
+    given fields changed."""
+    return {
+        "entity": "/home/uwu/uwu.py",
+        "type": "file",
+        "category": None,
+        "time": hb_time,
+        "is_write": True,
+        "project": "awoo",
+        "language": None,
+        "branch": None,
+        "lines": 10,
+        "lineno": None,
+        "cursorpos": None,
+        **fields,
+    }
@@ -0,0 +1,61 @@
+import gzip
+import json
+import time
+
+import pytest
+
+from rana.errors import PayloadTooLarge
+from rana.compression import gunzip
+from helper import make_heartbeat
+
+
+def test_gunzip_limit():
+    data = gzip.compress(b"a" * 1000)
+    assert gunzip(data, 1000) == b"a" * 1000
+
+    with pytest.raises(PayloadTooLarge):
+        gunzip(data, 999)
+
+
+@pytest.mark.asyncio
+async def test_gzip_bulk(test_cli_user):
+    """Test that gzipped bulk heartbeats are accepted."""
+    now = time.time()
+    heartbeats = [
+        make_heartbeat(now + idx, entity=f"/home/uwu/{idx}.py") for idx in range(10)
+    ]
+
+    resp = await test_cli_user.post(
+        "/api/v1/users/current/heartbeats.bulk",
+        data=gzip.compress(json.dumps(heartbeats).encode()),
+        headers={"content-type": "application/json", "content-encoding": "gzip"},
+    )
+    assert resp.status_code == 201
+    assert len((await resp.json)["responses"]) == 10
+
+    resp = await test_cli_user.post(
+        "/api/v1/users/current/heartbeats.bulk",
+        data=json.dumps(heartbeats).encode(),
+        headers={"content-type": "application/json", "content-encoding": "zstd"},
+    )
+    assert resp.status_code == 415
+
+
+@pytest.mark.asyncio
+async def test_compressed_response(test_cli_user):
+    """Test that large JSON responses are gzipped for clients that
+    accept it, and only for them."""
+    path = "/api/v1/users/current/summaries?start=2019-01-01&end=2019-02-01"
+
+    resp = await test_cli_user.get(path, headers={"accept-encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["vary"]
+
+    body = gzip.decompress(await resp.get_data())
+    assert len(json.loads(body)["data"]) == 32
+
+    resp = await test_cli_user.get(path, headers={"accept-encoding": "gzip;q=0"})
+    assert resp.status_code == 200
+    assert "content-encoding" not in resp.headers
+    assert len((await resp.json)["data"]) == 32
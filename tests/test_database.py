@@ -0,0 +1,45 @@
+import time
+import secrets
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_interned_strings(app):
+    """Test that strings go through intern and resolve unchanged, with
+    and without the caches knowing them."""
+    await app.db.ready.wait()
+    values = [f"/home/uwu/{time.time()}.py", "uwulang", None]
+
+    ids = await app.db.intern(values)
+    assert set(ids) == set(values[:2])
+    assert app.db.string_ids.get(values[0]) == ids[values[0]]
+
+    assert await app.db.resolve([*ids.values(), None]) == {
+        string_id: value for value, string_id in ids.items()
+    }
+
+    # interning again gives the same ids, from the database this time
+    app.db.string_ids.clear()
+    app.db.strings.clear()
+    assert await app.db.intern(values) == ids
+
+    app.db.strings.clear()
+    resolved = await app.db.resolve(ids.values())
+    assert resolved == {string_id: value for value, string_id in ids.items()}
+    assert app.db.strings.get(ids[values[0]]) == values[0]
+
+
+@pytest.mark.asyncio
+async def test_interned_long_strings(app):
+    """Test that strings too long for a btree are interned."""
+    await app.db.ready.wait()
+    # random, so it doesn't compress below the limit either
+    value = "https://uwu.example/" + secrets.token_hex(8000)
+
+    ids = await app.db.intern([value])
+    app.db.string_ids.clear()
+    app.db.strings.clear()
+
+    assert await app.db.intern([value]) == ids
+    assert await app.db.resolve(ids.values()) == {ids[value]: value}
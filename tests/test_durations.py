@@ -1,10 +1,20 @@
 import time
+import random
+import asyncio
 import datetime
 import dateutil.parser
 
 import pytest
 
-from rana.blueprints.heartbeats import process_hb, fetch_machine
+import rana.rollups
+from rana.errors import NotFound
+from rana.blueprints.heartbeats import process_hb, process_many_hbs, fetch_machine
+from rana.blueprints.durations import (
+    durations_from_rows,
+    _durations_from_rows_py,
+    _durations_from_rows_np,
+)
+from helper import make_heartbeat
 
 
 @pytest.mark.asyncio
@@ -30,6 +40,86 @@ async def test_heartbeats(test_cli_user):
     assert data["project"] == "awoo"
 
 
+@pytest.mark.asyncio
+async def test_heartbeats_bulk(test_cli_user):
+    """Test bulk heartbeat creation, including deduplication of
+    close heartbeats in the same batch."""
+    now = time.time()
+    resp = await test_cli_user.post(
+        "/api/v1/users/current/heartbeats.bulk",
+        json=[
+            {"entity": "/home/uwu/uwu.py", "type": "file", "time": now},
+            {"entity": "/home/uwu/uwu.py", "type": "file", "time": now + 1},
+            {"entity": "/home/uwu/owo.py", "type": "file", "time": now + 2},
+            {"entity": "/home/uwu/uwu.py", "type": "file", "time": now + 600},
+        ],
+    )
+
+    assert resp.status_code == 201
+    rjson = await resp.json
+    responses = rjson["responses"]
+    assert isinstance(responses, list)
+    assert len(responses) == 4
+
+    assert responses[0]["id"] == responses[1]["id"]
+    assert len({resp["id"] for resp in responses}) == 3
+    assert responses[2]["entity"] == "/home/uwu/owo.py"
+
+
+@pytest.mark.asyncio
+async def test_heartbeats_recent(test_cli_user):
+    """Test that a repeated heartbeat is caught by the window of recent
+    heartbeats, and answered with the heartbeat we already have."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    now = time.time()
+
+    resp = await test_cli_user.post(
+        "/api/v1/users/current/heartbeats",
+        json={"entity": "/home/uwu/uwu.py", "type": "file", "time": now},
+    )
+    assert resp.status_code == 201
+    first = (await resp.json)["data"]
+
+    recent = app.db.recent_heartbeats.get((user_id, "/home/uwu/uwu.py"))
+    assert str(recent["id"]) == first["id"]
+
+    # so that only the window can know about it
+    await app.db.execute("delete from heartbeats where user_id = $1", user_id)
+
+    resp = await test_cli_user.post(
+        "/api/v1/users/current/heartbeats",
+        json={"entity": "/home/uwu/uwu.py", "type": "file", "time": now + 1},
+    )
+    assert resp.status_code == 201
+    assert (await resp.json)["data"] == first
+
+    count = await app.db.fetchval(
+        "select count(*) from heartbeats where user_id = $1", user_id
+    )
+    assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_fetch_machine_concurrent(test_cli_user):
+    """Test that requests racing to create the same machine all get
+    the same one."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+
+    mach_ids = await asyncio.gather(
+        *(fetch_machine(user_id, "racing_machine", app_=app) for _ in range(10))
+    )
+    assert len(set(mach_ids)) == 1
+
+    count = await app.db.fetchval(
+        "select count(*) from machines where user_id = $1 and name = $2",
+        user_id,
+        "racing_machine",
+    )
+    assert count == 1
+
+
 async def do_heartbeats(test_cli_user, minutes=10, *, project="awoo", start=None):
     """Add heartbeats."""
     start = start or datetime.datetime.now()
@@ -143,3 +233,314 @@ async def test_summaries(test_cli_user):
     # due to the amount of time spent in them
     assert projects[0]["name"] == "awoo"
     assert projects[1]["name"] == "awoo2"
+
+
+async def _full_durations(app, user_id) -> list:
+    """Calculate the user's durations from scratch, out of every
+    heartbeat they have."""
+    rows = await app.db.fetch(
+        """
+    SELECT s.user_id, s.language_id, s.project_id, s.started_at, s.ended_at
+    FROM (
+        SELECT user_id, language_id, project_id, time AS started_at,
+               (LAG(time) OVER (ORDER BY time DESC)) AS ended_at
+        FROM heartbeats
+        WHERE user_id = $1 and is_write = true
+        GROUP BY user_id, language_id, project_id, time
+        ORDER BY started_at) AS s
+    WHERE s.ended_at - s.started_at < 600
+    """,
+        user_id,
+    )
+
+    return [
+        (dur["project"], dur["language"], dur["start"], dur["end"])
+        for dur in durations_from_rows(rows)
+    ]
+
+
+async def _stored_durations(app, user_id) -> list:
+    rows = await app.db.fetch(
+        """
+    select project_id, language_id, started_at, ended_at
+    from durations
+    where user_id = $1
+    order by started_at
+    """,
+        user_id,
+    )
+
+    return [tuple(row) for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_durations_incremental(test_cli_user):
+    """Test that the durations table, updated as heartbeats arrive
+    (in order or not), matches durations calculated from scratch."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+
+    rand = random.Random(1)
+    start = time.time() - 86400
+    heartbeats = []
+
+    hb_time = start
+    for idx in range(120):
+        hb_time += rand.choice([30, 90, 200, 500, 700, 2000])
+        heartbeats.append(
+            {
+                "entity": f"/home/uwu/{idx}.py",
+                "type": "file",
+                "category": None,
+                "time": hb_time,
+                "is_write": rand.random() < 0.9,
+                "project": rand.choice(["awoo", "awoo2"]),
+                "language": rand.choice(["uwulang", None]),
+                "branch": None,
+                "lines": 10,
+                "lineno": None,
+                "cursorpos": None,
+            }
+        )
+
+    # most heartbeats arrive in order, then an offline backlog
+    # full of older heartbeats comes in.
+    rand.shuffle(heartbeats)
+    backlog, live = heartbeats[:40], heartbeats[40:]
+    live.sort(key=lambda hb: hb["time"])
+
+    for heartbeat in live:
+        await process_hb(user_id, mach_id, heartbeat, app_=app)
+
+    await process_many_hbs(user_id, mach_id, backlog, app_=app)
+
+    assert await _stored_durations(app, user_id) == await _full_durations(
+        app, user_id
+    )
+
+
+@pytest.mark.asyncio
+async def test_durations_backlog_batches(test_cli_user):
+    """Test that small batches of heartbeats landing between and around
+    the ones we already have give the same durations as a full
+    recalculation."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+    start = time.time() - 86400
+
+    def _hb(idx, offset, project="awoo"):
+        return {
+            "entity": f"/home/uwu/{idx}.py",
+            "type": "file",
+            "category": None,
+            "time": start + offset,
+            "is_write": True,
+            "project": project,
+            "language": "uwulang",
+            "branch": None,
+            "lines": 10,
+            "lineno": None,
+            "cursorpos": None,
+        }
+
+    # an isolated heartbeat, then a duration
+    await process_many_hbs(
+        user_id,
+        mach_id,
+        [_hb(0, 1000), _hb(1, 5000), _hb(2, 5300), _hb(3, 5900)],
+        app_=app,
+    )
+
+    batches = [
+        # pairs up with the isolated heartbeat before it
+        [_hb(4, 1300)],
+        # joins the isolated one to the duration after it
+        [_hb(5, 1800), _hb(6, 2300), _hb(7, 2800), _hb(8, 3300)],
+        [_hb(9, 3800), _hb(10, 4400)],
+        # splits a duration in two
+        [_hb(11, 5600, project="awoo2")],
+        # right before the first heartbeat
+        [_hb(12, 700)],
+        # between heartbeats that are already paired up
+        [_hb(13, 5100), _hb(14, 5200)],
+    ]
+
+    for batch in batches:
+        await process_many_hbs(user_id, mach_id, batch, app_=app)
+        assert await _stored_durations(app, user_id) == await _full_durations(
+            app, user_id
+        )
+
+    rand = random.Random(3)
+    for idx in range(15, 60):
+        offset = rand.uniform(0, 7000)
+        project = rand.choice(["awoo", "awoo2"])
+        await process_many_hbs(user_id, mach_id, [_hb(idx, offset, project)], app_=app)
+
+    assert await _stored_durations(app, user_id) == await _full_durations(app, user_id)
+
+
+def test_durations_from_rows_numpy():
+    """Test that the numpy durations engine gives the same durations
+    as the plain loop."""
+    pytest.importorskip("numpy")
+    rand = random.Random(2)
+
+    rows = []
+    hb_time = 1558000000.0
+    for _ in range(2000):
+        next_time = hb_time + rand.choice([1, 30.5, 120, 599])
+        rows.append(
+            (
+                rand.choice(["a", "b"]),
+                rand.choice(["uwulang", None]),
+                rand.choice(["awoo", "awoo2", None]),
+                hb_time,
+                next_time,
+            )
+        )
+        # rows only cover heartbeats less than 10 minutes apart,
+        # so there can be holes between them
+        hb_time = next_time + rand.choice([0, 0, 300, 599, 600, 700])
+
+    for do_user in (False, True):
+        assert _durations_from_rows_np(rows, do_user) == _durations_from_rows_py(
+            rows, do_user
+        )
+
+    assert _durations_from_rows_np([], False) == []
+    assert _durations_from_rows_np(rows[:1], False) == _durations_from_rows_py(
+        rows[:1], False
+    )
+
+
+async def _heartbeat_at(test_cli_user, mach_id, hb_time, project="awoo"):
+    app = test_cli_user.cli.app
+    return await process_hb(
+        test_cli_user.user["id"],
+        mach_id,
+        make_heartbeat(hb_time, project=project, language="uwulang", branch="master"),
+        app_=app,
+    )
+
+
+async def _summaries(test_cli_user, start, end):
+    resp = await test_cli_user.get(
+        "/api/v1/users/current/summaries?"
+        f"start={start.year}-{start.month}-{start.day}&"
+        f"end={end.year}-{end.month}-{end.day}"
+    )
+    assert resp.status_code == 200
+    return (await resp.json)["data"]
+
+
+@pytest.mark.asyncio
+async def test_summaries_midnight(test_cli_user):
+    """Test that multi-day summaries split durations crossing midnight
+    the same way single-day summaries do."""
+    now = datetime.datetime.utcnow()
+    today = datetime.datetime(now.year, now.month, now.day)
+    yesterday = today - datetime.timedelta(days=1)
+
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+    midnight = today.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    for minute in range(-10, 10):
+        await _heartbeat_at(test_cli_user, mach_id, midnight + minute * 60)
+
+    both = await _summaries(test_cli_user, yesterday, today)
+    assert len(both) == 2
+    assert both[0] == (await _summaries(test_cli_user, yesterday, yesterday))[0]
+    assert both[1] == (await _summaries(test_cli_user, today, today))[0]
+
+    assert both[0]["grand_total"]["total_seconds"] == 600
+    assert both[1]["grand_total"]["total_seconds"] == 540
+    assert both[1]["branches"][0]["name"] == "master"
+
+
+@pytest.mark.asyncio
+async def test_summaries_stale(test_cli_user):
+    """Test that heartbeats arriving for days that already have a
+    summary update them."""
+    now = datetime.datetime.utcnow()
+    today = datetime.datetime(now.year, now.month, now.day)
+    yesterday = today - datetime.timedelta(days=1)
+
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+    noon = yesterday.replace(tzinfo=datetime.timezone.utc).timestamp() + 43200
+
+    await _heartbeat_at(test_cli_user, mach_id, noon)
+    await _heartbeat_at(test_cli_user, mach_id, noon + 60)
+
+    summary = (await _summaries(test_cli_user, yesterday, yesterday))[0]
+    assert summary["grand_total"]["total_seconds"] == 60
+
+    # an offline backlog, before the heartbeats we already have
+    await _heartbeat_at(test_cli_user, mach_id, noon - 300)
+
+    stale = await app.db.fetchval(
+        "select stale from rollup_days where user_id = $1 and day = $2",
+        user_id,
+        yesterday.date(),
+    )
+    assert stale
+
+    assert await app.rollups.run_cycle() >= 1
+
+    summary = (await _summaries(test_cli_user, yesterday, yesterday))[0]
+    assert summary["grand_total"]["total_seconds"] == 360
+
+
+@pytest.mark.asyncio
+async def test_rollup_job_failures(test_cli_user, monkeypatch):
+    """Test that the rollup job skips users whose days fail to refresh,
+    and forgets the days of users that are gone."""
+    now = datetime.datetime.utcnow()
+    today = datetime.datetime(now.year, now.month, now.day)
+    yesterday = today - datetime.timedelta(days=1)
+
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+    noon = yesterday.replace(tzinfo=datetime.timezone.utc).timestamp() + 43200
+
+    await _heartbeat_at(test_cli_user, mach_id, noon)
+    await _summaries(test_cli_user, yesterday, yesterday)
+    await _heartbeat_at(test_cli_user, mach_id, noon - 300)
+
+    async def _stale():
+        return await app.db.fetchval(
+            "select stale from rollup_days where user_id = $1 and day = $2",
+            user_id,
+            yesterday.date(),
+        )
+
+    async def _broken_refresh(*args):
+        raise RuntimeError("uwu")
+
+    monkeypatch.setattr(rana.rollups, "refresh_rollups", _broken_refresh)
+
+    job = rana.rollups.RollupJob(app)
+    assert await job.run_cycle() == 0
+    assert job.failures == 1
+    assert await _stale()
+
+    # the user is left alone for a while
+    monkeypatch.undo()
+    assert await job.run_cycle() == 0
+    assert await _stale()
+
+    async def _gone(user_id, *, app_=None):
+        raise NotFound("User not found")
+
+    monkeypatch.setattr(rana.rollups, "user_context", _gone)
+
+    job = rana.rollups.RollupJob(app)
+    assert await job.run_cycle() == 0
+    assert await _stale() is None
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+import rana.ingest
+from rana.errors import ServiceUnavailable
+from rana.ingest import IngestQueue
+from rana.blueprints.heartbeats import fetch_machine
+from helper import make_heartbeat
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_flush(test_cli_user):
+    """Test that queued heartbeats get inserted on flush."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+
+    queue = IngestQueue(app)
+    now = time.time()
+
+    res = queue.put_many(
+        user_id,
+        mach_id,
+        [make_heartbeat(now), make_heartbeat(now, entity="/home/uwu/owo.py")],
+    )
+
+    assert len(res) == 2
+    assert queue.depth == 2
+
+    await queue.close()
+    assert queue.depth == 0
+    assert queue.flushed_heartbeats == 2
+
+    count = await app.db.fetchval(
+        "select count(*) from heartbeats where user_id = $1", user_id
+    )
+    assert count == 2
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_full(test_cli_user):
+    """Test that a full queue refuses heartbeats."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+
+    queue = IngestQueue(app)
+    queue.max_depth = 1
+
+    with pytest.raises(ServiceUnavailable):
+        queue.put_many(
+            user_id,
+            None,
+            [
+                make_heartbeat(time.time(), entity="/a.py"),
+                make_heartbeat(time.time(), entity="/b.py"),
+            ],
+        )
+
+    assert queue.depth == 0
+
+
+@pytest.mark.asyncio
+async def test_ingest_queue_retry(test_cli_user, monkeypatch):
+    """Test that heartbeats that fail to be inserted are retried, and
+    dropped after too many attempts."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+
+    failures = 1
+    process_many_hbs = rana.ingest.process_many_hbs
+
+    async def _flaky_process(*args, **kwargs):
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise ConnectionError("database went away")
+
+        return await process_many_hbs(*args, **kwargs)
+
+    monkeypatch.setattr(rana.ingest, "process_many_hbs", _flaky_process)
+
+    queue = IngestQueue(app)
+    queue.flush_interval = 0
+    queue.max_retries = 1
+    now = time.time()
+
+    queue.put_many(user_id, mach_id, [make_heartbeat(now)])
+    await queue.flush()
+    assert queue.flush_errors == 1
+    assert queue.depth == 1
+
+    await queue.flush()
+    assert queue.retried_heartbeats == 1
+    assert queue.flushed_heartbeats == 1
+    assert queue.depth == 0
+
+    # fails once, then again on its only retry
+    failures = 2
+    queue.put_many(user_id, mach_id, [make_heartbeat(now, entity="/home/uwu/owo.py")])
+    await queue.flush()
+    await queue.flush()
+    assert queue.dropped_heartbeats == 1
+    assert queue.depth == 0
+
+    count = await app.db.fetchval(
+        "select count(*) from heartbeats where user_id = $1", user_id
+    )
+    assert count == 1
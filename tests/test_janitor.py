@@ -0,0 +1,146 @@
+import time
+import datetime
+
+import pytest
+
+from rana.janitor import DataJanitor
+from rana.database import month_partition
+from rana.blueprints.heartbeats import process_hb, fetch_machine
+from helper import make_heartbeat
+
+
+async def _old_heartbeat(app, user_id, mach_id, hb_time):
+    return await process_hb(
+        user_id,
+        mach_id,
+        make_heartbeat(hb_time, entity=f"/home/uwu/{hb_time}.py"),
+        app_=app,
+    )
+
+
+@pytest.mark.asyncio
+async def test_janitor(test_cli_user):
+    """Test that the janitor removes old heartbeats, dropping
+    entire partitions when possible."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+
+    name, start, end = month_partition(2000, 1)
+    await app.db.execute(
+        f"""
+    create table if not exists {name}
+        partition of heartbeats
+        for values from ({start}) to ({end})
+    """
+    )
+
+    now = time.time()
+    old = now - datetime.timedelta(days=60).total_seconds()
+
+    await _old_heartbeat(app, user_id, mach_id, start + 10)
+    await _old_heartbeat(app, user_id, mach_id, old)
+    await _old_heartbeat(app, user_id, mach_id, old + 120)
+    await _old_heartbeat(app, user_id, mach_id, now)
+
+    # summaries calculated out of them
+    old_day = datetime.date(2000, 1, 1)
+    today = datetime.date.today()
+    for day in (old_day, today):
+        await app.db.execute(
+            """
+        insert into daily_rollups (user_id, day, total_seconds)
+        values ($1, $2, 60)
+        """,
+            user_id,
+            day,
+        )
+        await app.db.execute(
+            """
+        insert into rollup_days (user_id, day, timezone) values ($1, $2, 'UTC')
+        """,
+            user_id,
+            day,
+        )
+        await app.db.execute(
+            """
+        insert into leaderboard_buckets (day, user_id, total_seconds)
+        values ($1, $2, 60)
+        """,
+            day,
+            user_id,
+        )
+    await app.db.execute(
+        "insert into leaderboard_days (day) values ($1) on conflict do nothing",
+        old_day,
+    )
+
+    janitor = DataJanitor(app)
+    janitor.limit_days = 30
+    janitor.chunk_size = 1
+
+    # out of time before doing anything
+    janitor.runtime = 0
+    assert await janitor.run_cycle() == (0, pytest.approx(0, abs=1))
+    janitor.runtime = 30
+
+    removed, _ = await janitor.run_cycle()
+    # the dropped partition counts as its estimated rows
+    assert removed >= 2
+    assert janitor.partitions_dropped >= 1
+
+    times = await app.db.fetch(
+        "select time from heartbeats where user_id = $1", user_id
+    )
+    assert [row[0] for row in times] == [now]
+
+    durations = await app.db.fetchval(
+        "select count(*) from durations where user_id = $1 and ended_at < $2",
+        user_id,
+        now - 86400,
+    )
+    assert durations == 0
+
+    for table in ("daily_rollups", "rollup_days", "leaderboard_buckets"):
+        days = await app.db.fetch(
+            f"select day from {table} where user_id = $1", user_id
+        )
+        assert [row[0] for row in days] == [today]
+
+    assert not await app.db.fetchval(
+        "select count(*) from leaderboard_days where day = $1", old_day
+    )
+
+    assert not await app.db.fetchval("select to_regclass($1)", name)
+
+
+@pytest.mark.asyncio
+async def test_partitions(test_cli_user):
+    """Test that heartbeats for a new month land on its partition
+    once it's created."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    mach_id = await fetch_machine(user_id, "test_machine", app_=app)
+
+    # the first month that doesn't have a partition yet
+    utcnow = datetime.datetime.utcnow()
+    year, month = utcnow.year, utcnow.month
+    for _ in range(app.db.partitions_ahead + 1):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    name, start, _ = month_partition(year, month)
+    assert not await app.db.fetchval("select to_regclass($1)", name)
+
+    try:
+        app.db.partitions_ahead += 1
+        await app.db.create_partitions()
+
+        await _old_heartbeat(app, user_id, mach_id, start + 10)
+        table = await app.db.fetchval(
+            "select tableoid::regclass::text from heartbeats where user_id = $1",
+            user_id,
+        )
+        assert table == name
+    finally:
+        app.db.partitions_ahead -= 1
+        await app.db.execute(f"drop table if exists {name}")
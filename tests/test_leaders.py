@@ -0,0 +1,209 @@
+import asyncio
+import datetime
+from collections import Counter
+
+import pytest
+
+from rana.leaderboards import LeaderboardSnapshot, LeaderboardWindow, mark_days_stale
+from test_durations import do_heartbeats
+
+
+def test_leaderboard_ranks():
+    """Test that the most active users rank first, starting at 1."""
+    snapshot = LeaderboardSnapshot(
+        None,
+        {
+            "a": Counter({"uwulang": 10}),
+            "b": Counter({"uwulang": 20, "owolang": 20}),
+            "c": Counter({"owolang": 30}),
+        },
+        0,
+    )
+
+    assert snapshot.sorted_leaders == ["b", "c", "a"]
+    assert [snapshot.rank(uid) for uid in "abc"] == [3, 1, 2]
+    assert snapshot.rank("d") is None
+
+
+@pytest.mark.asyncio
+async def test_leaders(test_cli_user):
+    """Test that leaderboards come from the latest snapshot."""
+    app = test_cli_user.cli.app
+    await do_heartbeats(
+        test_cli_user, 10, start=datetime.datetime.now() - datetime.timedelta(days=2)
+    )
+    await app.leaderboards.refresh()
+
+    resp = await test_cli_user.get("/api/v1/leaders")
+    assert resp.status_code == 200
+    rjson = await resp.json
+
+    assert rjson["modified_at"] is not None
+    assert str(test_cli_user.user["id"]) in [
+        leader["user"]["id"] for leader in rjson["data"]
+    ]
+
+    ranks = [leader["rank"] for leader in rjson["data"]]
+    assert ranks == list(range(1, len(ranks) + 1))
+
+    totals = [leader["running_total"]["total_seconds"] for leader in rjson["data"]]
+    assert totals == sorted(totals, reverse=True)
+
+    current_user = rjson["current_user"]
+    assert current_user["user"] == rjson["user"]
+    assert current_user["user"]["id"] == str(test_cli_user.user["id"])
+
+    resp = await test_cli_user.get("/api/v1/leaders?language=uwulang")
+    assert resp.status_code == 200
+    rjson = await resp.json
+    leader = next(
+        leader
+        for leader in rjson["data"]
+        if leader["user"]["id"] == str(test_cli_user.user["id"])
+    )
+    assert list(leader["running_total"]["languages"]) == ["uwulang"]
+    assert leader["running_total"]["total_seconds"] == pytest.approx(540, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_window(test_cli_user):
+    """Test that heartbeats for closed days update their buckets."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    start = datetime.datetime.now() - datetime.timedelta(days=3)
+
+    await do_heartbeats(test_cli_user, 10, start=start)
+    await app.leaderboards.refresh()
+
+    snapshot = await app.leaderboards.fetch()
+    before = snapshot.global_rank[user_id]
+
+    # an offline backlog, right before the first batch
+    await do_heartbeats(test_cli_user, 5, start=start - datetime.timedelta(minutes=5))
+    await app.leaderboards.refresh()
+
+    snapshot = await app.leaderboards.fetch()
+    assert snapshot.global_rank[user_id] == pytest.approx(before + 300)
+    assert len(app.leaderboards.window.buckets) == 7
+
+
+class _StaleWhileCalculating:
+    """The app's database, but with heartbeats arriving for the given
+    time while a bucket's durations are read."""
+
+    def __init__(self, db, hb_time: float):
+        self.db = db
+        self.hb_time = hb_time
+
+    def transaction(self):
+        return self.db.transaction()
+
+    async def fetch(self, query, *args):
+        async with self.db.transaction() as conn:
+            await mark_days_stale(conn, self.hb_time, self.hb_time)
+
+        return await self.db.fetch(query, *args)
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_generations(test_cli_user):
+    """Test that a bucket is only saved when its day didn't go stale
+    while it was calculated."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    start, _ = await do_heartbeats(
+        test_cli_user, 10, start=datetime.datetime.now() - datetime.timedelta(days=2)
+    )
+    await app.leaderboards.refresh()
+
+    hb_time = start.timestamp()
+    day = datetime.datetime.utcfromtimestamp(hb_time).date()
+
+    async def _day():
+        row = await app.db.fetchrow(
+            "select stale, generation from leaderboard_days where day = $1", day
+        )
+        return tuple(row)
+
+    async def _user_seconds():
+        return await app.db.fetchval(
+            """
+        select sum(total_seconds) from leaderboard_buckets
+        where day = $1 and user_id = $2
+        """,
+            day,
+            user_id,
+        )
+
+    stale, generation = await _day()
+    assert not stale
+    assert await _user_seconds() == pytest.approx(540, abs=1)
+
+    # only the first heartbeat of a fresh day has to update it
+    for _ in range(2):
+        async with app.db.transaction() as conn:
+            await mark_days_stale(conn, hb_time, hb_time)
+        assert await _day() == (True, generation + 1)
+
+    await app.db.execute("delete from durations where user_id = $1", user_id)
+
+    window = app.leaderboards.window
+    await window._calc_bucket(_StaleWhileCalculating(app.db, hb_time), day)
+    assert await _day() == (True, generation + 2)
+    assert await _user_seconds() == pytest.approx(540, abs=1)
+
+    await window._calc_bucket(app.db, day)
+    assert await _day() == (False, generation + 2)
+    assert await _user_seconds() is None
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_other_process(test_cli_user):
+    """Test that buckets calculated again by another process are
+    loaded again."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    start = datetime.datetime.now() - datetime.timedelta(days=3)
+    today = datetime.datetime.utcnow().date()
+
+    await do_heartbeats(test_cli_user, 10, start=start)
+    window = LeaderboardWindow()
+    await window.sync(app.db, today)
+    before = window.totals()
+
+    await do_heartbeats(test_cli_user, 5, start=start - datetime.timedelta(minutes=5))
+    assert await LeaderboardWindow().sync(app.db, today) >= 1
+
+    assert await window.sync(app.db, today) == 0
+    after = window.totals()
+    seconds = sum(val for (uid, _), val in after.items() if uid == user_id)
+    assert seconds == pytest.approx(
+        sum(val for (uid, _), val in before.items() if uid == user_id) + 300
+    )
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_new_day(test_cli_user):
+    """Test that a day without a row yet waits for the heartbeats
+    that touched it."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+    start, _ = await do_heartbeats(
+        test_cli_user, 10, start=datetime.datetime.now() - datetime.timedelta(days=2)
+    )
+
+    hb_time = start.timestamp()
+    day = datetime.datetime.utcfromtimestamp(hb_time).date()
+    await app.db.execute("delete from leaderboard_days where day = $1", day)
+
+    window = LeaderboardWindow()
+    async with app.db.transaction() as conn:
+        await mark_days_stale(conn, hb_time, hb_time)
+
+        calc = asyncio.ensure_future(window._calc_bucket(app.db, day))
+        await asyncio.sleep(0.2)
+        assert not calc.done()
+
+    bucket, _ = await calc
+    seconds = sum(val for (uid, _), val in bucket.items() if uid == user_id)
+    assert seconds == pytest.approx(540, abs=1)
@@ -0,0 +1,71 @@
+import pytest
+
+from rana.queries import QUERIES
+from rana.metrics import Histogram, query_name
+
+
+def test_query_name():
+    assert query_name(QUERIES["durations_range"]) == "durations_range"
+    assert query_name("select id from durations") == "select durations"
+    assert query_name("\n    insert into machines (id) values ($1)") == (
+        "insert machines"
+    )
+    assert query_name("BEGIN;") == "begin;"
+
+
+def test_histogram_render():
+    hist = Histogram("test_seconds", "Test.", ["query"], buckets=(0.1, 1.0))
+    hist.observe(0.05, query="a")
+    hist.observe(0.5, query="a")
+    hist.observe(5, query="a")
+
+    lines = hist.render()
+    assert 'test_seconds_bucket{query="a",le="0.1"} 1.0' in lines
+    assert 'test_seconds_bucket{query="a",le="1.0"} 2.0' in lines
+    assert 'test_seconds_bucket{query="a",le="+Inf"} 3.0' in lines
+    assert 'test_seconds_count{query="a"} 3.0' in lines
+
+
+@pytest.mark.asyncio
+async def test_metrics(test_cli_user):
+    resp = await test_cli_user.get("/api/v1/users/current")
+    assert resp.status_code == 200
+
+    # disabled unless configured
+    resp = await test_cli_user.get("/metrics")
+    assert resp.status_code == 404
+
+    app = test_cli_user.cli.app
+    app.cfg.set("rana", "metrics", "1")
+    try:
+        resp = await test_cli_user.get("/metrics")
+    finally:
+        app.cfg.remove_option("rana", "metrics")
+
+    assert resp.status_code == 200
+    body = (await resp.get_data()).decode()
+
+    assert (
+        'rana_request_seconds_count{endpoint="users.get_current_user",'
+        'method="GET",status="200"}'
+    ) in body
+    assert 'rana_db_query_seconds_count{query="api_key_user"}' in body
+    assert 'rana_db_pool_size{pool="primary"}' in body
+    assert "rana_password_jobs_total " in body
+    assert "rana_janitor_dropped_partitions_total " in body
+
+
+@pytest.mark.asyncio
+async def test_prepared_queries(app):
+    """Test that pool connections start with the named queries
+    prepared, without running them for real."""
+    await app.db.ready.wait()
+
+    async with app.db.conn.acquire() as conn:
+        rows = await conn.fetch("select statement from pg_prepared_statements")
+
+    statements = {row[0] for row in rows}
+    assert set(QUERIES.values()) <= statements
+
+    # warming up doesn't count as running them
+    assert ("heartbeats_insert",) not in app.metrics.query_rows.values
@@ -0,0 +1,137 @@
+import uuid
+
+import asyncpg
+import pytest
+
+from rana.migrations import (
+    migrate,
+    schema_version,
+    _drop_invalid_indexes,
+    LATEST_VERSION,
+    MIGRATIONS,
+)
+
+
+@pytest.mark.asyncio
+async def test_migrations_up_to_date(app):
+    """Test that startup leaves the schema at the latest version, and
+    that migrating it again doesn't do anything."""
+    await app.db.ready.wait()
+
+    async with app.db.conn.acquire() as conn:
+        assert await schema_version(conn) == LATEST_VERSION
+        assert await migrate(conn) == 0
+
+    indexes = await app.db.fetch(
+        """
+    select indexname from pg_indexes
+    where indexname = any($1::text[])
+    """,
+        ["api_keys_key_idx", "machines_user_id_name_idx", "rollup_days_stale_idx"],
+    )
+    assert len(indexes) == 3
+
+
+@pytest.mark.asyncio
+async def test_migrations_unversioned(app):
+    """Test that a database from before the schema was versioned, with
+    its heartbeats in the original shape, gets migrated."""
+    await app.db.ready.wait()
+
+    user_id = uuid.uuid4()
+    machines = [uuid.uuid4(), uuid.uuid4()]
+
+    async with app.db.conn.acquire() as conn:
+        await conn.execute("create schema rana_unversioned")
+        try:
+            await conn.execute("set search_path to rana_unversioned")
+            await conn.execute(MIGRATIONS[0].statements[0])
+
+            await conn.execute(
+                """
+            insert into users (id, username, password_hash, created_at)
+            values ($1, 'old', '', 0)
+            """,
+                user_id,
+            )
+            await conn.executemany(
+                "insert into machines (id, user_id, name) values ($1, $2, 'uwu')",
+                [(machine_id, user_id) for machine_id in machines],
+            )
+            await conn.executemany(
+                """
+            insert into heartbeats (id, user_id, machine_id, entity, type,
+                time, is_write, project, lines)
+            values ($1, $2, $3, '/uwu.py', 'file', $4, true, $5, 10)
+            """,
+                [
+                    (uuid.uuid4(), user_id, machines[0], 1558000000, "awoo"),
+                    (uuid.uuid4(), user_id, machines[1], 1558000256, "awoo"),
+                    (uuid.uuid4(), user_id, machines[1], 1558000512, "awoo2"),
+                    (uuid.uuid4(), user_id, machines[0], 1558003200, "awoo2"),
+                ],
+            )
+
+            assert await migrate(conn) == LATEST_VERSION
+            assert await schema_version(conn) == LATEST_VERSION
+
+            assert await conn.fetchval("select count(*) from machines") == 1
+            rows = await conn.fetch(
+                """
+            select heartbeats.tableoid::regclass::text, machine_id, entity.value
+            from heartbeats
+            join interned_strings entity on entity.id = heartbeats.entity_id
+            """
+            )
+            assert len(rows) == 4
+            assert {tuple(row) for row in rows} == {
+                ("heartbeats_y2019m05", rows[0][1], "/uwu.py")
+            }
+
+            durations = await conn.fetch(
+                """
+            select project.value, started_at, ended_at
+            from durations
+            join interned_strings project on project.id = durations.project_id
+            order by started_at
+            """
+            )
+            assert [tuple(row) for row in durations] == [
+                ("awoo", 1558000000, 1558000512)
+            ]
+        finally:
+            await conn.execute("reset search_path")
+            await conn.execute("drop schema rana_unversioned cascade")
+
+
+@pytest.mark.asyncio
+async def test_drop_invalid_indexes(app):
+    """Test that only the invalid indexes of a migration are dropped
+    before it runs again."""
+    await app.db.ready.wait()
+
+    async with app.db.conn.acquire() as conn:
+        await conn.execute("create schema rana_invalid")
+        try:
+            await conn.execute("set search_path to rana_invalid")
+            await conn.execute(
+                "create table dups as select 1 as x from generate_series(1, 2)"
+            )
+
+            # failed concurrent builds leave invalid indexes behind
+            for name in ("api_keys_key_idx", "someone_elses_idx"):
+                with pytest.raises(asyncpg.UniqueViolationError):
+                    await conn.execute(
+                        f"create unique index concurrently {name} on dups (x)"
+                    )
+
+            migration = next(mig for mig in MIGRATIONS if mig.concurrently)
+            await _drop_invalid_indexes(conn, migration)
+
+            names = await conn.fetch(
+                "select indexname from pg_indexes where schemaname = 'rana_invalid'"
+            )
+            assert [row[0] for row in names] == ["someone_elses_idx"]
+        finally:
+            await conn.execute("reset search_path")
+            await conn.execute("drop schema rana_invalid cascade")
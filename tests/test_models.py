@@ -0,0 +1,72 @@
+import pytest
+
+from rana.models import (
+    HEARTBEAT_MODEL,
+    HEARTBEATS_BULK_IN,
+    LEADERS_IN,
+    compiled_schema,
+    _cerberus_validate,
+)
+
+HEARTBEATS = [
+    {"entity": "/home/uwu/uwu.py", "type": "file", "time": "1558000000.5"},
+    {
+        "entity": "/home/uwu/uwu.py",
+        "type": "file",
+        "category": "coding",
+        "time": 1558000000,
+        "project": "awoo",
+        "lines": "10",
+        "lineno": None,
+        "is_write": None,
+        "dependencies": ["os", "sys"],
+    },
+    {"entity": "/home/uwu/uwu.py", "type": "file", "lines": None, "cursorpos": "2"},
+    # invalid ones
+    {"entity": None, "type": "file"},
+    {"entity": "/home/uwu/uwu.py", "type": "directory"},
+    {"entity": "/home/uwu/uwu.py", "type": "file", "lines": "many"},
+    {"entity": "/home/uwu/uwu.py", "type": "file", "unknown": 1},
+    {"entity": "/home/uwu/uwu.py", "type": "file", "dependencies": [1]},
+    {"type": "file"},
+]
+
+
+@pytest.mark.parametrize("heartbeat", HEARTBEATS)
+def test_compiled_heartbeat(heartbeat):
+    """Test that the compiled validator gives the same results
+    as cerberus."""
+    expected_document, expected_errors = _cerberus_validate(heartbeat, HEARTBEAT_MODEL)
+    document, errors = compiled_schema(HEARTBEAT_MODEL).validate(heartbeat)
+
+    assert errors == expected_errors
+    if not errors:
+        assert document == expected_document
+
+
+def test_compiled_bulk():
+    document, errors = compiled_schema(HEARTBEATS_BULK_IN).validate(
+        {"hbs": HEARTBEATS[:3]}
+    )
+    assert not errors
+    assert document == _cerberus_validate({"hbs": HEARTBEATS[:3]}, HEARTBEATS_BULK_IN)[0]
+
+    _, errors = compiled_schema(HEARTBEATS_BULK_IN).validate({"hbs": HEARTBEATS})
+    assert errors == _cerberus_validate({"hbs": HEARTBEATS}, HEARTBEATS_BULK_IN)[1]
+
+
+def test_compiled_defaults():
+    document, errors = compiled_schema(LEADERS_IN).validate({"page": "2"})
+    assert not errors
+    assert document == {"page": 2}
+
+    document, errors = compiled_schema(LEADERS_IN).validate({})
+    assert document == {"page": 0}
+
+
+def test_not_compilable():
+    """Test that schemas the compiled validator can't do are left
+    to cerberus."""
+    assert compiled_schema({"name": {"type": "string", "maxlength": 10}}) is None
+    assert compiled_schema({"name": {"type": "uwutype"}}) is None
+    assert compiled_schema({"name": {"type": "username"}}) is not None
@@ -0,0 +1,60 @@
+import pytest
+
+from rana.replicas import ReplicaSet
+from rana.database import RanaConnection
+
+
+@pytest.fixture
+async def replicas(app):
+    """Yield a set of replicas that is actually the test database,
+    used by app.db while the test runs."""
+    await app.db.ready.wait()
+
+    dsn = app.cfg["rana:database"]
+    uri = (
+        f'postgresql://{dsn["user"]}:{dsn["password"]}'
+        f'@{dsn.get("host", "localhost")}/{dsn.get("database", dsn["user"])}'
+    )
+
+    app.cfg.set("rana", "db_replicas", uri)
+    try:
+        replica_set = ReplicaSet(app)
+    finally:
+        app.cfg.remove_option("rana", "db_replicas")
+
+    await replica_set.connect(min_size=1, max_size=1, connection_class=RanaConnection)
+
+    orig_replicas = app.db.replicas
+    app.db.replicas = replica_set
+    yield replica_set
+    app.db.replicas = orig_replicas
+
+    await replica_set.close()
+
+
+@pytest.mark.asyncio
+async def test_replica_reads(app, replicas):
+    """Test that replica reads go to replicas that are caught up, and
+    to the primary otherwise."""
+    assert replicas.replicas[0].lag == 0
+
+    assert await app.db.fetchval("select 1", replica=True) == 1
+    assert await app.db.fetchval("select 1") == 1
+    assert replicas.reads == 1
+    assert replicas.fallbacks == 0
+
+    # too far behind
+    replicas.max_lag = -1
+    assert await app.db.fetchval("select 1", replica=True) == 1
+    assert replicas.reads == 1
+    assert replicas.fallbacks == 1
+
+    # unreachable until the next check
+    replicas.max_lag = 10
+    replicas.mark_failed(replicas.replicas[0].pool)
+    assert await app.db.fetchval("select 1", replica=True) == 1
+    assert replicas.fallbacks == 2
+
+    await replicas.check()
+    assert await app.db.fetchval("select 1", replica=True) == 1
+    assert replicas.reads == 2
@@ -0,0 +1,25 @@
+import random
+import datetime
+
+import pytest
+
+from rana.timezones import get_timezone, timezone_table
+
+
+@pytest.mark.parametrize(
+    "olson_tz", [None, "UTC", "America/Sao_Paulo", "Europe/London", "Etc/GMT+3"]
+)
+def test_timezone_table(olson_tz):
+    """Test that converting through the transition table gives the
+    same datetimes as pytz."""
+    rand = random.Random(3)
+    tz = get_timezone(olson_tz)
+    table = timezone_table(tz)
+
+    for _ in range(1000):
+        tstamp = rand.uniform(0, 2_000_000_000)
+        expected = datetime.datetime.fromtimestamp(tstamp).astimezone(tz)
+        converted = table.fromtimestamp(tstamp)
+
+        assert converted == expected
+        assert converted.isoformat() == expected.isoformat()
@@ -1,5 +1,11 @@
+import asyncio
+import threading
+import urllib.parse
+
 import pytest
 
+from rana.database import API_KEYS_CHANNEL
+
 
 @pytest.mark.asyncio
 async def test_user_fetch(test_cli_user):
@@ -13,3 +19,90 @@ async def test_user_fetch(test_cli_user):
     assert isinstance(data["id"], str)
     assert isinstance(data["username"], str)
     assert isinstance(data["email"], str)
+
+
+@pytest.mark.asyncio
+async def test_user_cache(test_cli_user):
+    """Test that users are served from the cache until they're
+    invalidated."""
+    app = test_cli_user.cli.app
+    user_id = test_cli_user.user["id"]
+
+    user = await app.db.fetch_user(user_id)
+    assert user["display_name"] is None
+    assert user_id in app.db.users
+
+    await app.db.execute("update users set display_name = 'uwu' where id = $1", user_id)
+
+    # still the cached view
+    users = await app.db.fetch_users_simple([user_id])
+    assert users[user_id]["display_name"] is None
+
+    app.db.invalidate_user(user_id)
+    user = await app.db.fetch_user_simple(user_id)
+    assert user["display_name"] == "uwu"
+
+
+@pytest.mark.asyncio
+async def test_api_key_revoked(test_cli_user):
+    """Test that a revoked API key stops working right away, in this
+    process and in the others."""
+    app = test_cli_user.cli.app
+    api_key = str(test_cli_user.user["api_key"])
+
+    resp = await test_cli_user.get("/api/v1/users/current")
+    assert resp.status_code == 200
+    assert api_key in app.db.api_keys
+
+    # like another process would, without touching our cache
+    async with app.db.transaction() as conn:
+        await conn.execute(
+            "update api_keys set key = $2 where key = $1", api_key, "uwu"
+        )
+        await conn.execute("select pg_notify($1, $2)", API_KEYS_CHANNEL, api_key)
+
+    for _ in range(100):
+        if api_key not in app.db.api_keys:
+            break
+        await asyncio.sleep(0.01)
+
+    resp = await test_cli_user.get("/api/v1/users/current")
+    assert resp.status_code == 401
+
+    await app.db.revoke_api_key("uwu", api_key)
+    resp = await test_cli_user.get("/api/v1/users/current")
+    assert resp.status_code == 200
+
+    await app.db.revoke_api_key(api_key, "owo")
+    resp = await test_cli_user.get("/api/v1/users/current")
+    assert resp.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_password_pool_full(test_cli, test_user):
+    """Test that logins get a 503 with Retry-After while every password
+    worker is busy and no more jobs can wait."""
+    app = test_cli.app
+    pool = app.password_pool
+    max_waiting, pool.max_waiting = pool.max_waiting, 0
+
+    release = threading.Event()
+    busy = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(pool.workers)]
+
+    try:
+        while pool.pending < pool.workers:
+            await asyncio.sleep(0.01)
+
+        resp = await test_cli.post(
+            "/login",
+            data=urllib.parse.urlencode(
+                {"username": test_user["username"], "password": test_user["password"]}
+            ),
+        )
+        assert resp.status_code == 503
+        assert resp.headers["Retry-After"] == "1"
+        assert pool.rejected == 1
+    finally:
+        release.set()
+        await asyncio.gather(*busy)
+        pool.max_waiting = max_waiting